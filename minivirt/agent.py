@@ -0,0 +1,158 @@
+import base64
+import json
+import logging
+import secrets
+import socket
+import tempfile
+import time
+from pathlib import Path
+
+from .exceptions import AgentError, WaitTimeout
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 2
+READ_SIZE = 2**16
+POLL_MIN = 0.01
+POLL_MAX = 0.2
+
+
+class GuestAgent:
+    # Talks to qemu-guest-agent over its virtio-serial channel. The protocol
+    # is QMP without the greeting; there's no way to tell replies apart, so
+    # guest-sync-delimited skips whatever a previous client left unread.
+
+    def __init__(self, path, timeout=CONNECT_TIMEOUT):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.settimeout(timeout)
+        # Unix socket paths are limited to ~100 characters, so connect
+        # through a short symlink.
+        with tempfile.TemporaryDirectory() as tmp:
+            sock_path = Path(tmp) / 'sock'
+            sock_path.symlink_to(path)
+            self.sock.connect(str(sock_path))
+        self.file = self.sock.makefile('rb')
+        try:
+            self.sync()
+        except BaseException:
+            self.close()
+            raise
+
+    def send(self, command, **arguments):
+        msg = {'execute': command}
+        if arguments:
+            msg['arguments'] = arguments
+        logger.debug('Sending agent message: %s.', msg)
+        self.sock.sendall(json.dumps(msg).encode('utf8') + b'\n')
+
+    def read(self, size=-1):
+        try:
+            if size < 0:
+                data = self.file.readline()
+            else:
+                data = self.file.read(size)
+        except socket.timeout:
+            raise WaitTimeout('Guest agent is not answering')
+        if not data:
+            raise ConnectionResetError('Guest agent is gone')
+        return data
+
+    def sync(self):
+        sync_id = secrets.randbelow(2**31)
+        self.send('guest-sync-delimited', id=sync_id)
+        while True:
+            # The reply starts with a 0xff byte, which can't occur in JSON.
+            if self.read(1) != b'\xff':
+                continue
+            if json.loads(self.read()).get('return') == sync_id:
+                return
+
+    def execute(self, command, **arguments):
+        self.send(command, **arguments)
+        reply = json.loads(self.read())
+        logger.debug('Received agent message: %s.', reply)
+        if 'error' in reply:
+            raise AgentError(reply['error']['desc'])
+        return reply['return']
+
+    def drain(self, handle, stream):
+        # End of file is sticky in libc; seeking clears it, so we see what
+        # the command wrote since the last read.
+        self.execute('guest-file-seek', handle=handle, offset=0, whence='cur')
+        received = 0
+        while True:
+            chunk = self.execute(
+                'guest-file-read', handle=handle, count=READ_SIZE
+            )
+            data = base64.b64decode(chunk['buf-b64'])
+            if data:
+                stream.write(data)
+                stream.flush()
+                received += len(data)
+            if len(data) < READ_SIZE:
+                return received
+
+    def exec(self, command, stdout, stderr):
+        # guest-exec only returns the output once the command exits, so the
+        # command writes to files in the guest, which we read as it runs.
+        token = secrets.token_hex(8)
+        outputs = []
+        try:
+            for name, stream in [('out', stdout), ('err', stderr)]:
+                path = f'/tmp/miv-{token}.{name}'
+                handle = self.execute('guest-file-open', path=path, mode='w+')
+                outputs.append((path, handle, stream))
+
+            # Match what a command run over ssh gets.
+            script = (
+                f'export HOME=/root; cd; '
+                f'exec >>{outputs[0][0]} 2>>{outputs[1][0]}\n{command}'
+            )
+            pid = self.execute(
+                'guest-exec', path='/bin/sh', arg=['-lc', script]
+            )['pid']
+
+            interval = POLL_MIN
+            while True:
+                status = self.execute('guest-exec-status', pid=pid)
+                received = sum(
+                    self.drain(handle, stream)
+                    for _, handle, stream in outputs
+                )
+                if status['exited']:
+                    break
+                if received:
+                    interval = POLL_MIN
+                else:
+                    interval = min(interval * 2, POLL_MAX)
+                time.sleep(interval)
+
+        finally:
+            self.remove_outputs(outputs)
+
+        if 'signal' in status:
+            return 128 + status['signal']
+        return status.get('exitcode', 0)
+
+    def remove_outputs(self, outputs):
+        try:
+            for _, handle, _ in outputs:
+                self.execute('guest-file-close', handle=handle)
+            if outputs:
+                self.execute(
+                    'guest-exec',
+                    path='/bin/rm',
+                    arg=['-f', *(path for path, _, _ in outputs)],
+                )
+        except (OSError, AgentError, WaitTimeout) as e:
+            logger.debug('Could not remove command output files: %s', e)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,285 @@
+import errno
+import gzip
+import logging
+import os
+import tarfile
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 2**20
+HOLE_SIZE = 2**16
+ZEROS = bytes(HOLE_SIZE)
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+COMPRESSIONS = ['gzip', 'zstd']
+
+
+class Meter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+        self.t0 = time.monotonic()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes += len(data)
+        return data
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def report(action, raw, wire):
+    elapsed = max(time.monotonic() - raw.t0, 1e-6)
+    logger.info(
+        '%s %.1f MB (%.1f MB archive) in %.1fs, %.1f MB/s',
+        action, raw.bytes / 1e6, wire.bytes / 1e6, elapsed,
+        raw.bytes / 1e6 / elapsed,
+    )
+
+
+class PrefixedReader:
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size < 0:
+            data = self.prefix + self.fileobj.read()
+        else:
+            data = self.prefix[:size]
+            if len(data) < size:
+                data += self.fileobj.read(size - len(data))
+        self.prefix = self.prefix[len(data):]
+        return data
+
+
+def data_segments(fd, size):
+    # (offset, length) of each region of the file that holds data.
+    segments = []
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            # The filesystem doesn't know about holes
+            return [(0, size)]
+        if start >= size:
+            break
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        segments.append((start, end - start))
+        pos = end
+    return segments
+
+
+class SparseMember:
+    # The contents of a GNU sparse 1.0 member: the sparse map, padded to a
+    # tar block, followed by the data segments. Holes are never read.
+
+    def __init__(self, f, size, segments):
+        self.fd = f.fileno()
+        if not segments or sum(segments[-1]) < size:
+            # Mark the end of the file, like GNU tar does.
+            segments = segments + [(size, 0)]
+        self.segments = segments
+        sparse_map = f'{len(segments)}\n' + ''.join(
+            f'{offset}\n{length}\n' for offset, length in segments
+        )
+        self.header = sparse_map.encode('ascii')
+        self.header += bytes(-len(self.header) % tarfile.BLOCKSIZE)
+        self.size = len(self.header) + sum(n for _, n in segments)
+        self.pieces = self.iter_pieces()
+        self.pending = memoryview(b'')
+
+    def iter_pieces(self):
+        yield self.header
+        for offset, length in self.segments:
+            end = offset + length
+            while offset < end:
+                data = os.pread(self.fd, min(BLOCK_SIZE, end - offset), offset)
+                if not data:
+                    raise OSError(f'File shrank while reading at {offset}')
+                offset += len(data)
+                yield data
+
+    def read(self, size=-1):
+        pieces = []
+        while size:
+            if not self.pending:
+                self.pending = memoryview(next(self.pieces, b''))
+                if not self.pending:
+                    break
+            piece = self.pending if size < 0 else self.pending[:size]
+            self.pending = self.pending[len(piece):]
+            pieces.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return b''.join(pieces)
+
+
+def sparse_tarinfo(tarinfo, member):
+    # Store `tarinfo` as a GNU sparse 1.0 member (PAX headers), which GNU
+    # tar and Python's tarfile both restore.
+    name = tarinfo.name
+    tarinfo.pax_headers = {
+        'GNU.sparse.major': '1',
+        'GNU.sparse.minor': '0',
+        'GNU.sparse.name': name,
+        'GNU.sparse.realsize': str(tarinfo.size),
+    }
+    tarinfo.name = os.path.join(
+        os.path.dirname(name), 'GNUSparseFile.0', os.path.basename(name)
+    )
+    tarinfo.size = member.size
+    return tarinfo
+
+
+def iter_blocks(fileobj, size):
+    while size > 0:
+        block = fileobj.read(min(BLOCK_SIZE, size))
+        if not block:
+            raise tarfile.ReadError('Unexpected end of archive')
+        size -= len(block)
+        yield block
+
+
+def write_sparse(f, block):
+    view = memoryview(block)
+    for offset in range(0, len(view), HOLE_SIZE):
+        piece = view[offset:offset + HOLE_SIZE]
+        if piece == ZEROS[:len(piece)]:
+            f.seek(len(piece), os.SEEK_CUR)
+        else:
+            f.write(piece)
+
+
+def member_path(root, name):
+    path = Path(name)
+    if path.is_absolute() or '..' in path.parts:
+        raise ValueError(f'Unsafe path in archive: {name!r}')
+    return root / path
+
+
+def compressor(fileobj, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=1)
+
+    if compression == 'zstd':
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(
+            fileobj, closefd=False
+        )
+
+    raise ValueError(f'Unknown compression {compression!r}')
+
+
+def decompressor(fileobj):
+    magic = fileobj.read(4)
+    fileobj = PrefixedReader(magic, fileobj)
+
+    if magic.startswith(ZSTD_MAGIC):
+        import zstandard
+
+        # Multithreaded and concatenated archives have several frames.
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True
+        )
+
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+    return fileobj
+
+
+def create(fileobj, path, names, compression=None):
+    wire = Meter(fileobj)
+    out = wire
+    if compression:
+        out = compressor(wire, compression)
+    raw = Meter(out)
+
+    with tarfile.open(
+        fileobj=raw, mode='w|', format=tarfile.PAX_FORMAT
+    ) as tar:
+        for name in names:
+            file_path = path / name
+            tarinfo = tar.gettarinfo(file_path, arcname=name)
+            if not tarinfo.isfile():
+                tar.addfile(tarinfo)
+                continue
+            with file_path.open('rb') as f:
+                segments = data_segments(f.fileno(), tarinfo.size)
+                if sum(n for _, n in segments) == tarinfo.size:
+                    # Probing for holes moved the file position.
+                    f.seek(0)
+                    tar.addfile(tarinfo, f)
+                    continue
+                member = SparseMember(f, tarinfo.size, segments)
+                tar.addfile(sparse_tarinfo(tarinfo, member), member)
+
+    if out is not wire:
+        out.close()
+    wire.flush()
+    report('Saved', raw, wire)
+
+
+def extract_sparse(source, f, member, hasher):
+    # Holes are only hashed; seeking past them leaves them unallocated.
+    pos = 0
+    for offset, length in member.sparse:
+        for block in iter_blocks(source, offset - pos):
+            hasher.update(block)
+        f.seek(offset)
+        for block in iter_blocks(source, length):
+            f.write(block)
+            hasher.update(block)
+        pos = offset + length
+    for block in iter_blocks(source, member.size - pos):
+        hasher.update(block)
+
+
+def extract(fileobj, path, open_hasher):
+    wire = Meter(fileobj)
+    raw = Meter(decompressor(wire))
+    with tarfile.open(fileobj=raw, mode='r|') as tar:
+        for member in tar:
+            target = member_path(path, member.name)
+            if member.isdir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+
+            if not member.isfile():
+                raise ValueError(f'Unsupported archive member {member.name!r}')
+
+            hasher = open_hasher(str(target.relative_to(path)))
+            if member.sparse is not None:
+                # tarfile reports the stored size when it's too large for
+                # the header, instead of the size of the file.
+                member.size = int(member.pax_headers.get(
+                    'GNU.sparse.realsize', member.size
+                ))
+            source = tar.extractfile(member)
+            with target.open('wb') as f:
+                if member.sparse is None:
+                    for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+                        write_sparse(f, block)
+                        hasher.update(block)
+                else:
+                    extract_sparse(source, f, member, hasher)
+                f.truncate(member.size)
+            os.utime(target, (member.mtime, member.mtime))
+
+    report('Loaded', raw, wire)
@@ -1,18 +1,19 @@
 import logging
 import re
-import shutil
 import socket
 import subprocess
 import sys
 import tempfile
+from contextlib import ExitStack
 from pathlib import Path
 
 import click
 import yaml
 
-from . import qemu
+from . import qcow2, qemu
+from .clone import clone_file
 from .utils import waitfor, WaitTimeout
-from .vms import VM
+from .vms import IMAGE_FEATURES, VM
 
 logger = logging.getLogger(__name__)
 
@@ -135,14 +136,34 @@ def create_disk_image(builder, size, attach=None, filename='disk.qcow2'):
 
 
 @build_step
-def download(builder, url, resize=None, attach=None, filename=None):
+def download(
+    builder, url, resize=None, attach=None, filename=None, sha256=None,
+    backing=False,
+):
     url = interpolate(url)
     if filename is None:
         filename = url.split('/')[-1]
     path = builder.vm.path / filename
     assert not path.exists()
-    cache_path = builder.db.cache.get(url)
-    shutil.copy(cache_path, path)
+
+    if backing:
+        # Keep the cached file locked until the build is committed, since
+        # the disk is an overlay on top of it.
+        cache_path = builder.resources.enter_context(
+            builder.db.cache.open(url, sha256)
+        )
+        backing_format = 'qcow2' if qcow2.is_qcow2(cache_path) else 'raw'
+        subprocess.check_call([
+            'qemu-img', 'create', '-f', 'qcow2',
+            '-b', cache_path, '-F', backing_format,
+            path,
+        ])
+        logger.info('Created %s on top of the cache', filename)
+
+    else:
+        with builder.db.cache.open(url, sha256) as cache_path:
+            method = clone_file(cache_path, path)
+        logger.info('Copied %s from cache (%s)', filename, method)
 
     if resize:
         subprocess.check_call(['qemu-img', 'resize', path, resize])
@@ -211,6 +232,7 @@ class Builder:
         self.db = db
         self.recipe = recipe
         self.verbose = verbose
+        self.resources = ExitStack()
 
     def wait(self, pattern, **kwargs):
         logger.debug('Waiting for pattern: %r', pattern)
@@ -279,7 +301,7 @@ class Builder:
         logger.info('Step: %r', name)
 
         try:
-            self.vm.ssh(run)
+            self.vm.execute(run)
         except subprocess.CalledProcessError:
             if not step.get('continue_on_error'):
                 raise
@@ -300,12 +322,17 @@ class Builder:
             image=image,
             memory=str(self.recipe['memory']),
         )
+        for key in IMAGE_FEATURES:
+            if key in self.recipe:
+                self.vm.config[key] = self.recipe[key]
+        self.vm.config.save()
 
-        for step in self.recipe['steps']:
-            self.build_step(step)
+        with self.resources:
+            for step in self.recipe['steps']:
+                self.build_step(step)
 
-        logger.info('Build finished.')
-        self.image = self.vm.commit()
+            logger.info('Build finished.')
+            self.image = self.vm.commit()
         return self.image
 
     def test(self):
@@ -322,7 +349,7 @@ class Builder:
             )
             with test_vm.run(wait_for_ssh=60):
                 try:
-                    out = test_vm.ssh(test['run'], capture=True)
+                    out = test_vm.execute(test['run'], capture=True)
                 except Exception:
                     logger.exception('Test %r error.', test_name)
                     raise ImageTestError
@@ -1,25 +1,272 @@
+import fcntl
 import hashlib
-import subprocess
+import logging
+import os
+import re
 import tempfile
-from pathlib import Path
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from .configs import Config
+from .exceptions import DownloadChecksumMismatch
+
+logger = logging.getLogger(__name__)
+
+MAX_SIZE = 20 * 2**30
+MAX_AGE = 24 * 3600
+TIMEOUT = 60
+BLOCK_SIZE = 2**20
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
 
 
 class Cache:
+    # Files are stored once, as `blobs/{sha256}`. Each URL has a metadata
+    # file in `urls/` that points to its blob.
+
     def __init__(self, path):
         self.path = path
+        self.blobs_path = path / 'blobs'
+        self.urls_path = path / 'urls'
+        self.config = Config(path / 'config.json')
+
+    @property
+    def max_size(self):
+        return self.config.get('max_size', MAX_SIZE)
+
+    @property
+    def max_age(self):
+        return self.config.get('max_age', MAX_AGE)
 
     def key(self, url):
         return hashlib.sha256(url.encode('utf8')).hexdigest()
 
-    def get(self, url):
+    def meta(self, key):
+        return Config(self.urls_path / f'{key}.json')
+
+    def blob_path(self, digest):
+        return self.blobs_path / digest
+
+    @contextmanager
+    def lock(self, name, blocking=True, shared=False):
+        locks_path = self.path / 'locks'
+        locks_path.mkdir(parents=True, exist_ok=True)
+        with (locks_path / f'{name}.lock').open('a') as f:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, url, sha256=None):
         key = self.key(url)
-        path = self.path / key
-        if path.exists():
-            return path
 
-        with tempfile.TemporaryDirectory(dir=self.path) as tmp:
-            tmp_path = Path(tmp) / key
-            subprocess.check_call(['curl', '-L', url, '-o', tmp_path])
-            tmp_path.rename(path)
+        # Concurrent requests for the same URL wait for a single download.
+        with self.lock(key):
+            meta = self.meta(key)
+            digest = meta.get('digest')
+            if sha256 and self.blob_path(sha256).exists():
+                # The blob's name is its checksum, there's nothing to check.
+                meta['digest'] = sha256
+                result = 'hits'
+            elif digest is None and (self.path / key).exists():
+                self.migrate(key, meta)
+                result = 'hits'
+            elif digest is None or not self.blob_path(digest).exists():
+                self.download(url, meta, expected=sha256)
+                result = 'misses'
+            elif time.time() - meta.get('checked', 0) < self.max_age:
+                result = 'hits'
+            else:
+                result = self.revalidate(url, meta, sha256)
+
+            if sha256 and meta['digest'] != sha256:
+                raise DownloadChecksumMismatch(
+                    f'{url}: expected sha256 {sha256}, got {meta["digest"]}'
+                )
+
+            meta.update(url=url, atime=time.time())
+            meta.save()
+            path = self.blob_path(meta['digest'])
+            size = path.stat().st_size
 
+        if result == 'misses':
+            self.record(misses=1, bytes_downloaded=size)
+        else:
+            self.record(**{result: 1}, bytes_saved=size)
+        self.evict(keep={path.name})
         return path
+
+    @contextmanager
+    def open(self, url, sha256=None):
+        # Hold a shared lock while the blob is in use, so it's not evicted.
+        while True:
+            path = self.get(url, sha256)
+            with self.lock(path.name, shared=True):
+                if path.exists():
+                    yield path
+                    return
+
+    def migrate(self, key, meta):
+        # Older versions stored files by URL hash, move them to the blobs.
+        legacy_path = self.path / key
+        digest = file_sha256(legacy_path)
+        self.store(legacy_path, digest)
+        meta.update(digest=digest, checked=time.time())
+
+    def revalidate(self, url, meta, sha256=None):
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        if not headers:
+            meta['checked'] = time.time()
+            return 'hits'
+
+        try:
+            self.download(url, meta, headers, sha256)
+
+        except HTTPError as e:
+            if e.code != 304:
+                raise
+            logger.debug('Cache entry for %s is still valid', url)
+            meta['checked'] = time.time()
+            return 'revalidated'
+
+        except URLError as e:
+            logger.warning('Could not revalidate %s (%s), using cache', url, e)
+            return 'hits'
+
+        return 'misses'
+
+    def download(self, url, meta, headers=None, expected=None):
+        logger.info('Downloading %s ...', url)
+        self.blobs_path.mkdir(parents=True, exist_ok=True)
+        sha256 = hashlib.sha256()
+        request = Request(url, headers=headers or {})
+        with urlopen(request, timeout=TIMEOUT) as response:
+            with tempfile.NamedTemporaryFile(
+                dir=self.blobs_path, delete=False
+            ) as f:
+                try:
+                    for block in iter(
+                        lambda: response.read(BLOCK_SIZE), b''
+                    ):
+                        sha256.update(block)
+                        f.write(block)
+                    # Don't let a wrong file into the cache.
+                    if expected and sha256.hexdigest() != expected:
+                        raise DownloadChecksumMismatch(
+                            f'{url}: expected sha256 {expected},'
+                            f' got {sha256.hexdigest()}'
+                        )
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+
+            last_modified = response.headers.get('Last-Modified')
+            if last_modified:
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+                os.utime(f.name, (mtime, mtime))
+
+            meta.update(
+                digest=sha256.hexdigest(),
+                etag=response.headers.get('ETag'),
+                last_modified=last_modified,
+                checked=time.time(),
+            )
+
+        self.store(f.name, meta['digest'])
+
+    def store(self, tmp_path, digest):
+        path = self.blob_path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            logger.info('Blob %s is already in the cache', digest)
+            self.record(bytes_deduplicated=os.stat(tmp_path).st_size)
+            os.unlink(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+    def record(self, **counters):
+        with self.lock('stats'):
+            stats = Config(self.path / 'stats.json')
+            for name, value in counters.items():
+                stats[name] = stats.get(name, 0) + value
+            stats.save()
+
+    def stats(self):
+        stats = Config(self.path / 'stats.json')
+        entries = list(self.iter_entries())
+        return dict(
+            stats.content,
+            entries=len(entries),
+            size=sum(entry['size'] for entry in entries),
+            max_size=self.max_size,
+        )
+
+    def iter_entries(self):
+        if not self.blobs_path.is_dir():
+            return
+
+        urls = {}
+        for meta_path in self.urls_path.glob('*.json'):
+            meta = self.meta(meta_path.stem)
+            urls.setdefault(meta.get('digest'), []).append(meta)
+
+        for path in self.blobs_path.iterdir():
+            if not re.match(r'^[0-9a-f]{64}$', path.name):
+                continue
+            metas = urls.get(path.name, [])
+            yield {
+                'digest': path.name,
+                'urls': [meta.get('url') for meta in metas],
+                'size': path.stat().st_size,
+                'atime': max(
+                    (meta.get('atime', 0) for meta in metas), default=0
+                ),
+            }
+
+    def evict(self, max_size=None, keep=()):
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self.iter_entries(), key=lambda e: e['atime'])
+        size = sum(entry['size'] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if size <= max_size:
+                break
+            if entry['digest'] in keep:
+                continue
+            # Skip blobs that someone is reading right now.
+            with self.lock(entry['digest'], blocking=False) as locked:
+                if not locked:
+                    continue
+                logger.info('Evicting %s from cache', entry['digest'])
+                self.blob_path(entry['digest']).unlink()
+            size -= entry['size']
+            evicted.append(entry)
+
+        if evicted:
+            self.record(evictions=len(evicted))
+        return evicted
+
+    def clear(self):
+        return self.evict(max_size=0)
@@ -0,0 +1,81 @@
+import hashlib
+import zlib
+
+from .exceptions import ImageChecksumMismatch
+
+READ_SIZE = 2**20
+SCAN_SIZE = 2**18
+MIN_CHUNK_SIZE = 2**18
+MAX_CHUNK_SIZE = 2**22
+
+
+def gear_table():
+    # Map each byte to 2 bits, a quarter of the byte values to each, picked
+    # by a fixed hash so that chunk boundaries never change.
+    order = sorted(
+        range(256), key=lambda i: hashlib.sha256(bytes([i])).digest()
+    )
+    table = bytearray(256)
+    for rank, i in enumerate(order):
+        table[i] = rank % 4
+    return bytes(table)
+
+
+GEAR = gear_table()
+# 10 bytes of 2 bits match 1 in 2**20 windows, giving chunks of
+# MIN_CHUNK_SIZE plus 1 MiB on average.
+BOUNDARY = bytes(
+    byte % 4 for byte in hashlib.sha256(b'minivirt').digest()[:10]
+)
+
+
+def cut_point(data):
+    """Length of the chunk at the start of `data`.
+
+    The rolling hash is a gear hash with 2-bit entries: the hash of a
+    window is the string of its bytes' entries, so it can be computed with
+    `translate()` and tested at every byte offset with `find()`. A boundary
+    only depends on the last 10 bytes, so inserting or removing bytes
+    anywhere only changes the chunks around the edit.
+    """
+    end = min(len(data), MAX_CHUNK_SIZE)
+    start = MIN_CHUNK_SIZE - len(BOUNDARY)
+    while start + len(BOUNDARY) < end:
+        stop = min(start + SCAN_SIZE, end)
+        index = data[start:stop].translate(GEAR).find(BOUNDARY)
+        if index >= 0:
+            return start + index + len(BOUNDARY)
+        start = stop - len(BOUNDARY) + 1
+    return end
+
+
+def iter_chunks(path):
+    """Split a file into content-defined chunks."""
+    data = bytearray()
+    with path.open('rb') as f:
+        while True:
+            while len(data) < MAX_CHUNK_SIZE:
+                block = f.read(READ_SIZE)
+                if not block:
+                    break
+                data += block
+            if not data:
+                return
+            size = cut_point(data)
+            yield digest(data[:size]), size
+            del data[:size]
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data):
+    return zlib.compress(data, 1)
+
+
+def decompress(data, expected):
+    data = zlib.decompress(data)
+    if digest(data) != expected:
+        raise ImageChecksumMismatch(f'Chunk {expected} is corrupt')
+    return data
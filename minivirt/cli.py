@@ -1,15 +1,17 @@
-import hashlib
+import json
 import logging
 import re
 import subprocess
 import sys
-from time import time
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 
-from . import build, qemu, remotes
+from . import archive, build, qemu, remotes, throttle
 from .contrib import githubactions
 from .db import DB, get_db_path, ImageNotFound
+from .diskusage import format_size, parse_size
 from .exceptions import RemoteNotFound, VmExists, VmIsRunning
 from .vms import PortForward, VM
 
@@ -19,6 +21,13 @@ logger = logging.getLogger(__name__)
 db = DB(get_db_path())
 
 
+def parse_limits(spec):
+    try:
+        return throttle.parse_limits(spec)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
 def parse_port_args(args):
     for arg in args:
         m = re.match(r'(?P<host_port>\d+):(?P<guest_port>\d+)$', arg)
@@ -50,11 +59,13 @@ def doctor():
         ['socat', '-h']
     ).startswith(b'socat by Gerhard Rieger and contributors')
 
-    tar_output = subprocess.check_output(['tar', '--version'])
-    assert any(impl in tar_output for impl in [b'GNU tar', b'bsdtar'])
-
-    assert b'minivirt/cli.py' in subprocess.check_output(['du', __file__])
-
+    db.path.mkdir(parents=True, exist_ok=True)
+    host = db.host.probe(db.path)
+    print(
+        f'cpus: {db.host.default_cpus()},'
+        f' direct I/O: {"yes" if host["direct_io"] else "no"},'
+        f' aio: {host["aio"]}'
+    )
     print('All ok')
 
 
@@ -64,9 +75,34 @@ def doctor():
 @click.option('-m', '--memory', default=1024)
 @click.option('--disk', default=None)
 @click.option('--port', multiple=True)
+@click.option('--cpus', type=int, default=None, help='Default: host CPUs, <=4')
+@click.option('--threads', type=int, default=None, help='Threads per core')
+@click.option(
+    '--iothreads/--no-iothreads', default=None,
+    help='Run each disk in its own I/O thread (default on)',
+)
+@click.option(
+    '--cache', default=None,
+    type=click.Choice(['none', 'writeback', 'writethrough', 'directsync']),
+    help='Disk cache mode (default: none, if the host supports O_DIRECT)',
+)
+@click.option(
+    '--aio', default=None,
+    type=click.Choice(['io_uring', 'native', 'threads']),
+    help='Disk AIO backend (default: the fastest the host supports)',
+)
+@click.option(
+    '--discard', default=None, type=click.Choice(['unmap', 'ignore'])
+)
+@click.option(
+    '--throttle', default=None, help='I/O limits, e.g. iops=500,bps=50M'
+)
+@click.option('--throttle-group', default=None)
 def create(image, name, **kwargs):
     if 'port' in kwargs:
         kwargs['ports'] = list(parse_port_args(kwargs.pop('port')))
+    if kwargs['throttle']:
+        kwargs['throttle'] = parse_limits(kwargs['throttle'])
 
     try:
         image = db.get_image(image)
@@ -86,6 +122,10 @@ def create(image, name, **kwargs):
 @click.option('--snapshot', is_flag=True)
 @click.option('--wait-for-ssh', type=int, default=None)
 @click.option('--usb', multiple=True)
+@click.option(
+    '--shared-memory', is_flag=True,
+    help='Keep guest RAM in a file, so --with-state commits can share it',
+)
 def start(name, **kwargs):
     vm = db.get_vm(name)
     try:
@@ -134,62 +174,132 @@ def ssh(name, args):
 @click.option('-m', '--memory', default=1024)
 @click.option('--port', multiple=True)
 @click.option('--wait-for-ssh', default=60)
+@click.option('--cpus', type=int, default=None)
 @click.argument('image_name')
 @click.argument('args', nargs=-1)
-def run(memory, port, wait_for_ssh, image_name, args):
+def run(memory, port, wait_for_ssh, cpus, image_name, args):
     ports = list(parse_port_args(port))
     try:
         image = db.get_image(image_name)
     except ImageNotFound:
         raise click.ClickException(f'Image {image_name!r} not found')
-    vm_name = hashlib.sha256(
-        f'{image.name}@{time()}'.encode('utf8')
-    ).hexdigest()
-    vm = VM.create(db, vm_name, image=image, memory=memory, ports=ports)
-    try:
-        with vm.run(wait_for_ssh=wait_for_ssh):
+    with db.pool.run(
+        image,
+        memory=memory,
+        ports=ports,
+        wait_for_ssh=wait_for_ssh,
+        cpus=cpus,
+    ) as vm:
+        if args and sys.stdin.isatty():
+            vm.execute(*args)
+        else:
+            # The agent doesn't forward stdin, ssh does.
             vm.ssh(*args)
-    finally:
-        vm.destroy()
 
 
 @cli.command()
 @click.option('-a', '--all', 'all_', is_flag=True)
-def ps(all_):
-    for vm in db.iter_vms():
-        is_running = vm.is_running
-        if not is_running and not all_:
-            continue
-        du_output = subprocess.check_output(['du', '-sh', vm.path])
-        size = du_output.decode('utf8').split()[0]
-        up_or_down = 'up' if is_running else 'down'
-        print(vm.name, up_or_down, size)
+@click.option('--json', 'json_', is_flag=True)
+@click.option('--memory', is_flag=True, help='Show shared and private RAM')
+@click.option('--probe', is_flag=True, help='Ask each VM for its status')
+def ps(all_, json_, memory, probe):
+    rows = []
+    vms = [(vm, vm.is_running) for vm in db.iter_vms()]
+    if not all_:
+        vms = [(vm, is_running) for vm, is_running in vms if is_running]
+    statuses = {}
+    if probe:
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            statuses = dict(zip(
+                (vm.name for vm, _ in vms),
+                executor.map(lambda item: item[0].probe(), vms),
+            ))
+
+    for vm, is_running in vms:
+        usage = vm.get_usage()
+        memory_usage = None
+        if memory and is_running and vm.pid:
+            memory_usage = vm.get_memory_usage()
+        if json_:
+            rows.append({
+                'name': vm.name,
+                'running': is_running,
+                'usage': usage,
+                'memory': memory_usage,
+                'status': statuses.get(vm.name),
+            })
+        else:
+            up_or_down = 'up' if is_running else 'down'
+            columns = [vm.name, up_or_down, format_size(usage['allocated'])]
+            if probe:
+                columns.append(statuses[vm.name])
+            if memory_usage:
+                columns += [
+                    f'{key}={format_size(memory_usage[key])}'
+                    for key in ['rss', 'shared', 'private']
+                ]
+            print(*columns)
+
+    if json_:
+        print(json.dumps(rows, indent=2))
 
 
 @cli.command()
-def images():
+@click.option('--json', 'json_', is_flag=True)
+def images(json_):
+    rows = []
     for image in db.iter_images():
-        size = image.get_size()
-        print(
-            image.short_name,
-            size,
-            ' '.join(tag.name for tag in image.iter_tags()),
-        )
+        usage = image.get_usage()
+        tags = [tag.name for tag in image.iter_tags()]
+        if json_:
+            rows.append({'id': image.name, 'tags': tags, 'usage': usage})
+        else:
+            print(image.short_name, format_size(usage['allocated']), *tags)
+
+    if json_:
+        print(json.dumps(rows, indent=2))
 
 
 @cli.command()
 @click.argument('name')
 @click.argument('tag')
-def commit(name, tag):
+@click.option(
+    '--with-state', is_flag=True,
+    help='Save the memory of the running VM, so new VMs resume from it',
+)
+def commit(name, tag, with_state):
     vm = db.get_vm(name)
-    image = vm.commit()
+    if with_state and not vm.is_running:
+        raise click.ClickException(f'VM {name!r} is not running')
+    image = vm.commit(state=with_state)
     image.tag(tag)
 
 
 @cli.command()
 @click.argument('image')
-def save(image):
-    db.save(image)
+@click.option('--flatten', is_flag=True)
+@click.option(
+    '--compression', type=click.Choice(archive.COMPRESSIONS), default=None
+)
+def save(image, flatten, compression):
+    parent_id = db.get_image(image).parent_id
+    if parent_id and not flatten:
+        logger.warning(
+            'Image is layered; loading it requires image %s. '
+            'Use --flatten to save a standalone image.', parent_id
+        )
+    db.save(image, flatten=flatten, compression=compression)
+
+
+@cli.command()
+@click.argument('image_name')
+@click.argument('tag')
+def flatten(image_name, tag):
+    try:
+        image = db.get_image(image_name)
+    except ImageNotFound:
+        raise click.ClickException(f'Image {image_name!r} not found')
+    image.flatten().tag(tag)
 
 
 @cli.command()
@@ -199,8 +309,21 @@ def load(image):
 
 
 @cli.command()
-def fsck():
-    result = db.fsck()
+@click.option('--fast', is_flag=True, help='Only re-hash modified files')
+@click.option(
+    '--sample', type=click.FloatRange(0, 1, min_open=True), default=None,
+    help='Fraction of chunks to verify in each file',
+)
+@click.option(
+    '--repair', is_flag=True,
+    help='Write missing manifests and rebuild the index',
+)
+def fsck(fast, sample, repair):
+    result = db.fsck(fast=fast, sample=sample, repair=repair)
+    logger.info(
+        'fsck hashed %.1f MB at %.1f MB/s',
+        result.bytes / 1e6, result.throughput / 1e6,
+    )
     for message in result.errors:
         logger.warning('fsck error: %s', message)
     if result.errors:
@@ -214,6 +337,11 @@ def prune(dry_run):
     db.prune(dry_run)
 
 
+@cli.command()
+def reindex():
+    db.reindex()
+
+
 @cli.command()
 @click.argument('image_name')
 @click.argument('tags', nargs=-1)
@@ -234,7 +362,8 @@ def untag(tags):
 @click.argument('remote_name')
 @click.argument('ref')
 @click.argument('remote_tag')
-def push(remote_name, ref, remote_tag):
+@click.option('--chunked', is_flag=True)
+def push(remote_name, ref, remote_tag, chunked):
     try:
         image = db.get_image(ref)
     except ImageNotFound:
@@ -243,7 +372,7 @@ def push(remote_name, ref, remote_tag):
         remote = db.remotes.get(remote_name)
     except RemoteNotFound:
         raise click.ClickException(f'Remote {remote_name!r} not found')
-    remote.push(image, remote_tag)
+    remote.push(image, remote_tag, chunked=chunked)
 
 
 @cli.command()
@@ -258,6 +387,227 @@ def pull(remote_name, remote_tag, tag):
     remote.pull(remote_tag.format(arch=qemu.arch), tag)
 
 
+@cli.group()
+def cache():
+    pass
+
+
+@cache.command(name='stats')
+@click.option('--json', 'json_', is_flag=True)
+def cache_stats(json_):
+    stats = db.cache.stats()
+    if json_:
+        print(json.dumps(stats, indent=2))
+        return
+
+    served = stats.get('hits', 0) + stats.get('revalidated', 0)
+    total = served + stats.get('misses', 0)
+    print(
+        f'entries: {stats["entries"]}\n'
+        f'size: {format_size(stats["size"])}'
+        f' / {format_size(stats["max_size"])}\n'
+        f'hits: {stats.get("hits", 0)}'
+        f' (revalidated: {stats.get("revalidated", 0)})\n'
+        f'misses: {stats.get("misses", 0)}\n'
+        f'hit rate: {served / total if total else 0:.0%}\n'
+        f'downloaded: {format_size(stats.get("bytes_downloaded", 0))}\n'
+        f'deduplicated: {format_size(stats.get("bytes_deduplicated", 0))}\n'
+        f'saved: {format_size(stats.get("bytes_saved", 0))}\n'
+        f'evictions: {stats.get("evictions", 0)}'
+    )
+
+
+@cache.command(name='ls')
+def cache_ls():
+    entries = sorted(db.cache.iter_entries(), key=lambda e: -e['atime'])
+    for entry in entries:
+        print(entry['digest'][:12], format_size(entry['size']), *entry['urls'])
+
+
+@cache.command(name='config')
+@click.option('--max-size', default=None, help='e.g. 20G')
+@click.option('--max-age', type=int, default=None, help='seconds')
+def cache_config(max_size, max_age):
+    if max_size is not None:
+        db.cache.config['max_size'] = parse_size(max_size)
+    if max_age is not None:
+        db.cache.config['max_age'] = max_age
+    db.cache.config.save()
+    db.cache.evict()
+    print(json.dumps(db.cache.config.content, indent=2))
+
+
+@cache.command(name='prune')
+def cache_prune():
+    for entry in db.cache.evict():
+        logger.info('Evicted %s', entry['digest'])
+
+
+@cache.command(name='clear')
+def cache_clear():
+    db.cache.clear()
+
+
+@cli.group()
+def pool():
+    pass
+
+
+@pool.command(name='status')
+@click.option('--json', 'json_', is_flag=True)
+def pool_status(json_):
+    stats = db.pool.stats()
+    if json_:
+        print(json.dumps(dict(stats, config=db.pool.config.content), indent=2))
+        return
+
+    print(f'max vms: {db.pool.max_vms}')
+    for image_id, target in db.pool.targets().items():
+        counts = stats['vms'].get(image_id, {})
+        print(
+            image_id[:12],
+            f'size={target["size"]}',
+            f'memory={target["memory"]}',
+            f'idle={counts.get("idle", 0)}',
+            f'busy={counts.get("busy", 0)}',
+        )
+    print(f'hits: {stats["hits"]}, misses: {stats["misses"]}')
+    for counter in ['hits', 'misses']:
+        latency = stats.get(f'{counter}_latency')
+        if latency:
+            print(
+                f'{counter} latency: median {latency["median"]:.3f}s,'
+                f' max {latency["max"]:.3f}s'
+            )
+
+
+@pool.command(name='config')
+@click.option('--max-vms', type=int, default=None)
+@click.option('--image', 'image_name', default=None)
+@click.option('--size', type=int, default=None, help='0 removes the image')
+@click.option('-m', '--memory', type=int, default=None)
+def pool_config(max_vms, image_name, size, memory):
+    if max_vms is not None:
+        db.pool.config['max_vms'] = max_vms
+        db.pool.config.save()
+    if image_name is not None:
+        try:
+            image = db.get_image(image_name)
+        except ImageNotFound:
+            raise click.ClickException(f'Image {image_name!r} not found')
+        try:
+            db.pool.set_target(image, size, memory=memory)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    print(json.dumps(db.pool.config.content, indent=2))
+
+
+@pool.command(name='fill')
+def pool_fill():
+    db.pool.fill()
+
+
+@pool.command(name='drain')
+def pool_drain():
+    db.pool.drain()
+
+
+@cli.group(name='throttle')
+def throttle_group():
+    pass
+
+
+@throttle_group.command(name='set')
+@click.argument('name')
+@click.argument('limits')
+@click.option('--disk', default=None, help='Only limit this attached disk')
+def throttle_set(name, limits, disk):
+    vm = db.get_vm(name)
+    try:
+        vm.set_io_throttle(parse_limits(limits), disk=disk)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@throttle_group.command(name='group')
+@click.argument('group')
+@click.argument('limits')
+def throttle_group_set(group, limits):
+    db.throttle.set_group(group, parse_limits(limits))
+
+
+@throttle_group.command(name='join')
+@click.argument('name')
+@click.argument('group', required=False)
+def throttle_join(name, group):
+    # Without a group, the VM leaves its group.
+    vm = db.get_vm(name)
+    old_group = vm.config.get('throttle_group')
+    vm.config['throttle_group'] = group
+    vm.config.save()
+    db.throttle.rebalance(old_group)
+    if group:
+        db.throttle.rebalance(group)
+    elif vm.is_running:
+        vm.apply_io_throttle()
+
+
+@throttle_group.command(name='show')
+def throttle_show():
+    for group, limits in db.throttle.groups().items():
+        members = [vm.name for vm in db.throttle.members(group)]
+        print(f'group {group}', json.dumps(limits), *members)
+    for vm in db.iter_vms():
+        limits = vm.config.get('throttle')
+        group = vm.config.get('throttle_group')
+        if limits or group:
+            print(vm.name, json.dumps(limits or {}), group or '')
+
+
+@cli.command()
+@click.option('--image', 'image_name', default=None)
+@click.option('--days', type=float, default=None, help='Only recent runs')
+@click.option('--json', 'json_', is_flag=True)
+def stats(image_name, days, json_):
+    image_id = None
+    if image_name:
+        try:
+            image_id = db.get_image(image_name).name
+        except ImageNotFound:
+            raise click.ClickException(f'Image {image_name!r} not found')
+    since = days and time.time() - days * 24 * 3600
+    summary = db.history.summarize(image=image_id, since=since)
+
+    if json_:
+        rows = []
+        for (image, qemu_version, event), phases in summary.items():
+            rows.append({
+                'image': image,
+                'qemu': qemu_version,
+                'event': event,
+                'phases': phases,
+            })
+        print(json.dumps(rows, indent=2))
+        return
+
+    tags = {}
+    for image in db.iter_images():
+        tags[image.name] = [tag.name for tag in image.iter_tags()]
+
+    for (image, qemu_version, event), phases in sorted(
+        summary.items(), key=lambda item: [str(k) for k in item[0]]
+    ):
+        print(
+            (image or 'no image')[:12], *tags.get(image, []),
+            f'qemu {qemu_version}', event,
+        )
+        for phase, row in phases.items():
+            print(
+                f'  {phase:<8} n={row["count"]}',
+                *(f'{key}={row[key]:.3f}s' for key in row if key != 'count'),
+            )
+
+
 cli.add_command(remotes.cli, name='remote')
 cli.add_command(build.cli, name='build')
 cli.add_command(githubactions.cli, name='githubactions')
@@ -0,0 +1,91 @@
+import errno
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+BLOCK_SIZE = 2**20
+UNSUPPORTED = {
+    errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP,
+    errno.EPERM, errno.EXDEV,
+}
+
+
+def iter_data_segments(fd, size):
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            # The filesystem doesn't know about holes
+            yield pos, size
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        pos = end
+
+
+def reflink(src_fd, dst_fd, size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def copy_range(src_fd, dst_fd, size):
+    for start, end in iter_data_segments(src_fd, size):
+        pos = start
+        while pos < end:
+            copied = os.copy_file_range(
+                src_fd, dst_fd, end - pos, offset_src=pos, offset_dst=pos
+            )
+            if not copied:
+                break
+            pos += copied
+    os.ftruncate(dst_fd, size)
+
+
+def copy_sparse(src_fd, dst_fd, size):
+    for start, end in iter_data_segments(src_fd, size):
+        for pos in range(start, end, BLOCK_SIZE):
+            block = os.pread(src_fd, min(BLOCK_SIZE, end - pos), pos)
+            os.pwrite(dst_fd, block, pos)
+    os.ftruncate(dst_fd, size)
+
+
+METHODS = [('reflink', reflink), ('sparse', copy_sparse)]
+if hasattr(os, 'copy_file_range'):
+    METHODS.insert(1, ('copy_file_range', copy_range))
+
+
+def clone_file(src, dst, immutable=False):
+    # Copy `src` to `dst` with the cheapest method available, and return its
+    # name. Files that are `immutable` (neither will ever be modified) may
+    # share an inode.
+    if immutable:
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED | {errno.EMLINK}:
+                raise
+        else:
+            logger.debug('Hardlinked %s to %s', src, dst)
+            return 'hardlink'
+
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+        size = os.fstat(src_fd).st_size
+        for name, method in METHODS:
+            try:
+                method(src_fd, dst_fd, size)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED or method is copy_sparse:
+                    raise
+                os.ftruncate(dst_fd, 0)
+            else:
+                break
+
+    logger.debug('Copied %s to %s (%s)', src, dst, name)
+    return name
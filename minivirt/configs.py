@@ -1,4 +1,6 @@
 import json
+import os
+import tempfile
 from functools import cached_property
 
 
@@ -16,8 +18,11 @@ class Config:
 
     def save(self):
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        with self.path.open('w') as f:
+        with tempfile.NamedTemporaryFile(
+            'w', dir=self.path.parent, delete=False
+        ) as f:
             json.dump(self.content, f, indent=2)
+        os.replace(f.name, self.path)
 
         # Invalidate the cached_property `content`
         self.__dict__.pop('content', None)
@@ -11,6 +11,7 @@ from time import time
 
 import click
 
+from minivirt.throttle import parse_limits
 from minivirt.vms import VM
 
 logger = logging.getLogger(__name__)
@@ -65,7 +66,7 @@ def log_errors(func):
 
 
 @log_errors
-def runner(image_name, github_repo, memory):
+def runner(image_name, github_repo, memory, **options):
     from minivirt.cli import db
 
     logger.debug('Fetching runner registration token')
@@ -77,7 +78,7 @@ def runner(image_name, github_repo, memory):
     vm_name = _random_name('githubactions')
     image = db.get_image(image_name)
     logger.info('Runner %s creating', vm_name)
-    vm = VM.create(db, vm_name, image=image, memory=memory)
+    vm = VM.create(db, vm_name, image=image, memory=memory, **options)
     try:
         with vm.run(wait_for_ssh=30):
             vm.ssh(
@@ -173,9 +174,23 @@ def start_ngrok_tunnel(port):
 @click.argument('repo')
 @click.option('-m', '--memory', default=1024)
 @click.option('--concurrency', default=1)
-def serve(image, repo, memory, concurrency):
+@click.option(
+    '--throttle', default=None, help='I/O limits per runner, e.g. iops=500'
+)
+@click.option(
+    '--throttle-group', default=None,
+    help='Share the budget of this throttle group between runners',
+)
+def serve(image, repo, memory, concurrency, throttle, throttle_group):
     import waitress
 
+    options = {'throttle_group': throttle_group}
+    if throttle:
+        try:
+            options['throttle'] = parse_limits(throttle)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
     github_repo = github_repo_api(fetch_github_token(), repo)
     port = find_free_port()
     listen = f'127.0.0.1:{port}'
@@ -187,7 +202,9 @@ def serve(image, repo, memory, concurrency):
     try:
         with ThreadPoolExecutor(max_workers=concurrency) as executor:
             def start_runner():
-                executor.submit(runner, image, github_repo, memory)
+                executor.submit(
+                    runner, image, github_repo, memory, **options
+                )
 
             for run in github_repo.get_workflow_runs(status='queued'):
                 for job in get_workflow_run_jobs(run):
@@ -1,24 +1,43 @@
 import hashlib
 import json
 import logging
+import math
 import os
+import random
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from functools import cached_property
+from functools import cached_property, partial
 from io import StringIO
 from pathlib import Path
 
-from . import vms
+from . import archive, chunks, vms
 from .cache import Cache
-from .exceptions import ImageNotFound
+from .clone import clone_file
+from .diskusage import DiskUsage, format_size
+from .exceptions import ImageChecksumMismatch, ImageNotFound
+from .host import Host
+from .index import Index
+from .pool import Pool
 from .remotes import Remotes
+from .stats import History
+from .throttle import ThrottleGroups
 
 logger = logging.getLogger(__name__)
 
+SHA256 = 'sha256'
+MERKLE = 'merkle'
+
+CHUNK_SIZE = 4 * 2**20
+HASH_WORKERS = os.cpu_count() or 1
+
+MANIFEST_NAME = '.manifest.json'
+
 
 class Image:
     def __init__(self, db, name):
@@ -40,6 +59,21 @@ class Image:
         with self.config_path.open() as f:
             return json.load(f)
 
+    @cached_property
+    def parent_id(self):
+        return read_config(self.path).get('parent')
+
+    @property
+    def parent(self):
+        if self.parent_id:
+            return self.db.get_image(self.parent_id)
+
+    def iter_ancestors(self):
+        image = self.parent
+        while image:
+            yield image
+            image = image.parent
+
     @cached_property
     def iso_path(self):
         filename = self.config.get('iso')
@@ -56,28 +90,151 @@ class Image:
             logger.warning('Overwriting tag %s -> %s', name, old_target.name)
             tag_path.unlink()
         tag_path.symlink_to(target)
+        self.db.index.set_tag(name, self.name)
 
     def iter_tags(self):
-        for tag in self.db.iter_tags():
-            if tag.image_id == self.name:
-                yield tag
+        for name, image_id in self.db.index.tags(self.name):
+            yield Tag(self.db, name, image_id)
+
+    def fsck(self, fast=False, sample=None, result=None, repair=False):
+        if self.parent_id and not self.db.image_path(self.parent_id).is_dir():
+            yield f'missing parent image {self.parent_id}'
+
+        manifest = read_manifest(self.path)
+        if manifest is None or not (fast or sample):
+            digests = tree_digests(self.path)
+            if result:
+                result.count_bytes(self.path, digests)
+            if combine_digests(digests) != self.name:
+                yield 'invalid checksum'
+            elif manifest is None and repair:
+                write_manifest(self.path, digests)
+            elif manifest is None:
+                logger.warning(
+                    '%s has no manifest, run `miv fsck --repair` to create it',
+                    self,
+                )
+            return
+
+        files = manifest['files']
+        names = {str(p.relative_to(self.path)) for p in iter_tree(self.path)}
+        for name in sorted(names - set(files)):
+            yield f'unexpected file {name}'
+        for name in sorted(set(files) - names):
+            yield f'missing file {name}'
+        if names != set(files):
+            return
+
+        changed = False
+        for name, entry in files.items():
+            file_path = self.path / name
+            if fast and file_stat(file_path) == {
+                key: entry[key] for key in ['size', 'mtime_ns', 'ino']
+            }:
+                continue
 
-    def fsck(self):
-        if tree_checksum(self.path) != self.name:
+            if sample and 'chunks' in entry:
+                errors = list(self._check_chunks(
+                    file_path, entry, manifest['chunk_size'], sample, result
+                ))
+                yield from errors
+                if errors:
+                    return
+                continue
+
+            with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+                new_entry = file_digest(
+                    file_path, manifest['scheme'], executor
+                )
+            if result:
+                result.count_bytes(self.path, [name])
+            if new_entry['digest'] != entry['digest']:
+                yield f'invalid checksum for {name}'
+                return
+            files[name] = dict(new_entry, **file_stat(file_path))
+            changed = True
+
+        if combine_digests(files) != self.name:
             yield 'invalid checksum'
+        elif changed and repair:
+            write_manifest(self.path, files, manifest.get('cdc'))
+
+    def _check_chunks(self, file_path, entry, chunk_size, sample, result):
+        chunks = [bytes.fromhex(chunk) for chunk in entry['chunks']]
+        if merkle_root(chunks) != entry['digest']:
+            yield f'invalid manifest for {file_path.name}'
+            return
+        if file_path.stat().st_size != entry['size']:
+            yield f'invalid size for {file_path.name}'
+            return
+
+        count = min(len(chunks), math.ceil(len(chunks) * sample))
+        indices = sorted(random.sample(range(len(chunks)), count))
+        for index in indices:
+            offset = index * chunk_size
+            if chunk_digest(file_path, offset, chunk_size) != chunks[index]:
+                yield f'invalid chunk {index} in {file_path.name}'
+            if result:
+                result.bytes += min(chunk_size, entry['size'] - offset)
+
+    def get_usage(self):
+        return self.db.disk_usage.usage(self.path)
+
+    def get_manifest(self):
+        manifest = read_manifest(self.path)
+        if manifest is None:
+            write_manifest(self.path, tree_digests(self.path))
+            manifest = read_manifest(self.path)
+        return manifest
+
+    def get_cdc(self):
+        manifest = self.get_manifest()
+        if 'cdc' not in manifest:
+            logger.info('Splitting %s into chunks ...', self)
+            manifest['cdc'] = {
+                name: list(chunks.iter_chunks(self.path / name))
+                for name in manifest['files']
+            }
+            write_manifest(self.path, manifest['files'], manifest['cdc'])
+        return manifest['cdc']
+
+    def export_flat(self, path):
+        for file_path in iter_tree(self.path):
+            target = path / file_path.relative_to(self.path)
+            if file_path.name == 'config.json':
+                config = dict(self.config)
+                config.pop('parent', None)
+                with target.open('w') as f:
+                    json.dump(config, f, indent=2)
+            elif file_path.name == 'disk.qcow2' and self.parent_id:
+                subprocess.check_call([
+                    'qemu-img', 'convert', '-O', 'qcow2', file_path, target
+                ])
+            else:
+                clone_file(file_path, target, immutable=True)
+
+    def flatten(self):
+        if not self.parent_id:
+            return self
+        logger.info('Flattening %s', self)
+        with self.db.create_image() as creator:
+            self.export_flat(creator.path)
+        return creator.image
 
     def get_size(self):
-        du_output = subprocess.check_output(['du', '-sh', self.path])
-        return du_output.decode('utf8').split()[0]
+        return format_size(self.get_usage()['allocated'])
 
     def delete(self):
         shutil.rmtree(self.path)
+        self.db.index.remove_image(self.name)
 
 
 class Tag:
-    def __init__(self, db, name):
+    def __init__(self, db, name, image_id=None):
         self.db = db
         self.name = name
+        if image_id is not None:
+            self.image_id = image_id
 
     @cached_property
     def path(self):
@@ -89,6 +246,7 @@ class Tag:
 
     def delete(self):
         self.path.unlink()
+        self.db.index.remove_tag(self.name)
 
     def fsck(self):
         if not (self.db.images_path / self.image_id).exists():
@@ -107,37 +265,218 @@ def checksum(path):
     return hash.hexdigest()
 
 
-def tree_checksum(path):
-    tree = StringIO()
+def chunk_digest(path, offset, chunk_size=None):
+    with path.open('rb') as f:
+        f.seek(offset)
+        return hashlib.sha256(f.read(chunk_size or CHUNK_SIZE)).digest()
+
+
+def merkle_root(digests):
+    level = list(digests) or [hashlib.sha256(b'').digest()]
+    while len(level) > 1:
+        level = [
+            hashlib.sha256(b''.join(level[i:i + 2])).digest()
+            for i in range(0, len(level), 2)
+        ]
+    return level[0].hex()
+
+
+def merkle_chunks(path, executor):
+    offsets = range(0, path.stat().st_size, CHUNK_SIZE)
+    return list(executor.map(partial(chunk_digest, path), offsets))
+
+
+def merkle_checksum(path, executor):
+    return merkle_root(merkle_chunks(path, executor))
+
+
+def read_config(path):
+    config_path = path / 'config.json'
+    if not config_path.exists():
+        return {}
+    with config_path.open() as f:
+        return json.load(f)
+
+
+def checksum_scheme(path):
+    return read_config(path).get('checksum', SHA256)
+
+
+def iter_tree(path):
     for file_path in sorted(path.glob('**/*')):
-        tree.write(f'{file_path.relative_to(path)}:{checksum(file_path)}\n')
+        if file_path.relative_to(path) == Path(MANIFEST_NAME):
+            continue
+        yield file_path
+
+
+def file_digest(path, scheme, executor):
+    if scheme == MERKLE:
+        chunks = merkle_chunks(path, executor)
+        return {
+            'digest': merkle_root(chunks),
+            'chunks': [chunk.hex() for chunk in chunks],
+        }
+    return {'digest': checksum(path)}
+
+
+def tree_digests(path, scheme=None):
+    if scheme is None:
+        scheme = checksum_scheme(path)
+    if scheme not in [SHA256, MERKLE]:
+        raise ValueError(f'Unknown checksum scheme {scheme!r}')
+
+    digests = {}
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        for file_path in iter_tree(path):
+            name = str(file_path.relative_to(path))
+            digests[name] = file_digest(file_path, scheme, executor)
+    return digests
+
+
+def sha256_digest(data):
+    return hashlib.sha256(data).digest()
+
+
+class StreamDigest:
+    def __init__(self, executor, scheme=None):
+        self.executor = executor
+        self.schemes = [scheme] if scheme else [SHA256, MERKLE]
+        self.sha256 = hashlib.sha256()
+        self.buffer = bytearray()
+        self.chunks = []
+
+    def update(self, data):
+        if SHA256 in self.schemes:
+            self.sha256.update(data)
+
+        if MERKLE in self.schemes:
+            self.buffer += data
+            while len(self.buffer) >= CHUNK_SIZE:
+                self.submit_chunk(bytes(self.buffer[:CHUNK_SIZE]))
+                del self.buffer[:CHUNK_SIZE]
+
+    def submit_chunk(self, chunk):
+        # Keep a bounded number of chunks in memory while they're hashed.
+        if len(self.chunks) >= HASH_WORKERS * 2:
+            self.chunks[-HASH_WORKERS * 2].result()
+        self.chunks.append(self.executor.submit(sha256_digest, chunk))
+
+    def result(self, scheme):
+        if scheme == MERKLE:
+            if self.buffer:
+                self.submit_chunk(bytes(self.buffer))
+                self.buffer.clear()
+            chunks = [future.result() for future in self.chunks]
+            return {
+                'digest': merkle_root(chunks),
+                'chunks': [chunk.hex() for chunk in chunks],
+            }
+        return {'digest': self.sha256.hexdigest()}
+
+
+def combine_digests(digests):
+    tree = StringIO()
+    for name, entry in sorted(digests.items()):
+        tree.write(f'{name}:{entry["digest"]}\n')
     return hashlib.sha256(tree.getvalue().encode('utf8')).hexdigest()
 
 
+def tree_checksum(path, scheme=None):
+    return combine_digests(tree_digests(path, scheme))
+
+
+def file_stat(path):
+    stat = path.stat()
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'ino': stat.st_ino,
+    }
+
+
+def write_manifest(path, digests, cdc=None):
+    manifest = {
+        'scheme': checksum_scheme(path),
+        'chunk_size': CHUNK_SIZE,
+        'files': {
+            name: dict(entry, **file_stat(path / name))
+            for name, entry in digests.items()
+        },
+    }
+    if cdc:
+        manifest['cdc'] = cdc
+    with (path / MANIFEST_NAME).open('w') as f:
+        json.dump(manifest, f)
+
+
+def read_manifest(path):
+    try:
+        with (path / MANIFEST_NAME).open() as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
 class ImageCreator:
     def __init__(self, db):
         self.db = db
         db.images_path.mkdir(parents=True, exist_ok=True)
         self.path = Path(tempfile.mkdtemp(dir=db.images_path))
+        self.digests = None
+        self.cdc = None
 
     @contextmanager
-    def ctx(self):
+    def ctx(self, expected_id=None):
         try:
             yield self
-            self.image = self.commit()
+            self.image = self.commit(expected_id)
 
         finally:
             if self.path.exists():
                 shutil.rmtree(self.path)
 
-    def commit(self):
-        image_id = tree_checksum(self.path)
+    @contextmanager
+    def hashing(self):
+        config_path = self.path / 'config.json'
+        hashers = {}
+
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            def open_hasher(name):
+                scheme = None
+                if config_path.exists() and name != config_path.name:
+                    scheme = checksum_scheme(self.path)
+                hashers[name] = StreamDigest(executor, scheme)
+                return hashers[name]
+
+            yield open_hasher
+
+            scheme = checksum_scheme(self.path)
+            self.digests = {
+                name: hasher.result(scheme)
+                for name, hasher in hashers.items()
+                if name != MANIFEST_NAME
+            }
+
+    def extract(self, fileobj):
+        with self.hashing() as open_hasher:
+            archive.extract(fileobj, self.path, open_hasher)
+
+    def commit(self, expected_id=None):
+        digests = self.digests or tree_digests(self.path)
+        image_id = combine_digests(digests)
+        if expected_id and image_id != expected_id:
+            raise ImageChecksumMismatch(
+                f'Expected image {expected_id}, got {image_id}'
+            )
         image_path = self.db.image_path(image_id)
         if image_path.exists():
             logger.warning('Image %s already exists', image_id)
             # TODO check the image's checksum, just to be safe
         else:
             self.path.rename(image_path)
+            write_manifest(image_path, digests, self.cdc)
+        parent_id = read_config(image_path).get('parent')
+        self.db.index.add_image(image_id, parent_id)
         logger.info('Committed image %s', image_id)
         return self.db.get_image(image_id)
 
@@ -145,6 +484,16 @@ class ImageCreator:
 class FsckResult:
     def __init__(self):
         self.errors = []
+        self.bytes = 0
+        self.t0 = time.monotonic()
+
+    def count_bytes(self, path, names):
+        for name in names:
+            self.bytes += (path / name).stat().st_size
+
+    @property
+    def throughput(self):
+        return self.bytes / max(time.monotonic() - self.t0, 1e-6)
 
 
 class DB:
@@ -154,12 +503,39 @@ class DB:
         self.vms_path = self.path / 'vms'
         self.remotes = Remotes(self)
 
+    @cached_property
+    def index(self):
+        index = Index(self.path / 'index.sqlite')
+        if index.needs_rebuild():
+            self.reindex(index)
+        return index
+
+    @cached_property
+    def disk_usage(self):
+        return DiskUsage(self.path / 'diskusage.json')
+
     @cached_property
     def cache(self):
         cache_path = self.path / 'cache'
         cache_path.mkdir(parents=True, exist_ok=True)
         return Cache(cache_path)
 
+    @cached_property
+    def pool(self):
+        return Pool(self)
+
+    @cached_property
+    def host(self):
+        return Host(self)
+
+    @cached_property
+    def throttle(self):
+        return ThrottleGroups(self)
+
+    @cached_property
+    def history(self):
+        return History(self.path / 'stats.jsonl')
+
     def image_path(self, filename):
         return self.images_path / filename
 
@@ -175,9 +551,10 @@ class DB:
         image_path = self.image_path(name)
         if image_path.is_symlink():
             image_path.unlink()
+            self.index.remove_tag(name)
 
-    def create_image(self):
-        return ImageCreator(self).ctx()
+    def create_image(self, expected_id=None):
+        return ImageCreator(self).ctx(expected_id)
 
     def get_tag(self, name):
         if not name:
@@ -190,68 +567,136 @@ class DB:
     def get_vm(self, name):
         return vms.VM(self, name)
 
-    def save(self, name, stdout=sys.stdout):
-        subprocess.check_call(
-            'tar c *', shell=True, cwd=self.image_path(name), stdout=stdout
-        )
-
-    def load(self, name, stdin=sys.stdin, gzip=False):
-        with self.create_image() as creator:
-            flags = 'x'
-            if gzip:
-                flags += 'z'
-            subprocess.check_call(
-                ['tar', flags], cwd=creator.path, stdin=stdin
+    def save(self, name, stdout=sys.stdout, flatten=False, compression=None):
+        image = self.get_image(name)
+        with tempfile.TemporaryDirectory(dir=self.images_path) as tmp:
+            path = image.path
+            if image.parent_id and flatten:
+                path = Path(tmp)
+                image.export_flat(path)
+
+            names = [str(p.relative_to(path)) for p in iter_tree(path)]
+            archive.create(
+                getattr(stdout, 'buffer', stdout), path, names, compression
             )
-        creator.image.tag(name)
+
+    def load(
+        self, name, stdin=sys.stdin, gzip=False, fetch_parent=None,
+        expected_id=None,
+    ):
+        # Compression is detected automatically, `gzip` is only accepted
+        # for backwards compatibility.
+        with self.create_image(expected_id) as creator:
+            creator.extract(getattr(stdin, 'buffer', stdin))
+            self.require_parent(creator.path, fetch_parent)
+        if name:
+            creator.image.tag(name)
+        return creator.image
+
+    def local_chunks(self):
+        # Images that were built or loaded locally are split into chunks
+        # now; the chunks are saved in their manifest for next time.
+        found = {}
+        for image in self.iter_images():
+            try:
+                cdc = image.get_cdc()
+            except FileNotFoundError:
+                # Deleted in the meantime.
+                continue
+            for name, file_chunks in cdc.items():
+                offset = 0
+                for digest, size in file_chunks:
+                    found[digest] = (image.path / name, offset, size)
+                    offset += size
+        return found
+
+    def require_parent(self, path, fetch_parent=None):
+        parent_id = read_config(path).get('parent')
+        if not parent_id or self.image_path(parent_id).is_dir():
+            return
+
+        if fetch_parent is None:
+            raise ImageNotFound(f'Parent image {parent_id} not found')
+
+        fetch_parent(parent_id)
 
     def iter_images(self):
+        for image_id in self.index.image_ids():
+            yield Image(self, image_id)
+
+    def iter_tags(self):
+        for name, image_id in self.index.tags():
+            yield Tag(self, name, image_id)
+
+    def iter_vms(self):
+        for name, _ in self.index.vms():
+            yield vms.VM(self, name)
+
+    def scan_images(self):
         for path in self.images_path.glob('*'):
-            if path.is_symlink():
+            if path.is_symlink() or not path.is_dir():
+                continue
+            if not re.match(r'^[0-9a-f]{64}$', path.name):
                 continue
             yield Image(self, path.name)
 
-    def iter_tags(self):
+    def scan_tags(self):
         for path in self.images_path.glob('*'):
             if not path.is_symlink():
                 continue
             yield Tag(self, path.name)
 
-    def iter_vms(self):
+    def scan_vms(self):
         for path in self.vms_path.glob('*'):
             yield vms.VM(self, path.name)
 
-    def fsck(self):
+    def reindex(self, index=None):
+        if index is None:
+            index = self.index
+        logger.info('Rebuilding index from %s ...', self.path)
+        index.replace(
+            [(image.name, image.parent_id) for image in self.scan_images()],
+            [(tag.name, tag.image_id) for tag in self.scan_tags()],
+            [(vm.name, vm.config.get('image')) for vm in self.scan_vms()],
+        )
+
+    def index_is_current(self):
+        return (
+            set(self.index.images())
+            == {(image.name, image.parent_id) for image in self.scan_images()}
+            and set(self.index.tags())
+            == {(tag.name, tag.image_id) for tag in self.scan_tags()}
+            and set(self.index.vms())
+            == {(vm.name, vm.config.get('image')) for vm in self.scan_vms()}
+        )
+
+    def fsck(self, fast=False, sample=None, repair=False):
         result = FsckResult()
 
-        for image in self.iter_images():
-            for error in image.fsck():
+        for image in self.scan_images():
+            for error in image.fsck(fast, sample, result, repair):
                 result.errors.append(f'{image}: {error}')
 
-        for tag in self.iter_tags():
+        for tag in self.scan_tags():
             for error in tag.fsck():
                 result.errors.append(f'{tag}: {error}')
 
-        for vm in self.iter_vms():
+        for vm in self.scan_vms():
             for error in vm.fsck():
                 result.errors.append(f'{vm}: {error}')
 
+        if repair and not self.index_is_current():
+            logger.warning('Index is out of date, rebuilding')
+            self.reindex()
+        elif not self.index_is_current():
+            logger.warning('Index is out of date, run `miv reindex`')
+
         return result
 
     def prune(self, dry_run=False):
-        keep = set()
-        for tag in self.iter_tags():
-            logger.debug(
-                'Prune keeping %s tagged as %s', tag.image_id, tag.name
-            )
-            keep.add(tag.image_id)
-
-        for vm in self.iter_vms():
-            if vm.image:
-                logger.debug(
-                    'Prune keeping %s for vm %s', vm.image.name, vm.name
-                )
-                keep.add(vm.image.name)
+        keep = self.index.used_image_ids()
+        for image_id in sorted(keep):
+            logger.debug('Prune keeping %s', image_id)
 
         for image in self.iter_images():
             if image.name not in keep:
@@ -0,0 +1,108 @@
+import json
+import logging
+import math
+import os
+import tempfile
+from functools import cached_property
+from pathlib import Path
+
+from . import qcow2
+
+logger = logging.getLogger(__name__)
+
+UNITS = ['', 'K', 'M', 'G', 'T', 'P']
+
+
+def format_size(size):
+    for unit in UNITS:
+        if size < 1024 or unit == UNITS[-1]:
+            break
+        size /= 1024
+    if size < 10 and unit:
+        return f'{math.ceil(size * 10) / 10:.1f}{unit}'
+    return f'{math.ceil(size)}{unit}'
+
+
+def parse_size(value):
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in UNITS[1:]:
+        return int(float(value[:-1]) * 1024 ** UNITS.index(value[-1]))
+    return int(value)
+
+
+def iter_files(path):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def stat_key(stat):
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+class DiskUsage:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.dirty = False
+
+    @cached_property
+    def cache(self):
+        try:
+            with self.cache_path.open() as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_cache(self):
+        if not self.dirty:
+            return
+        cache = {
+            path: entry for path, entry in self.cache.items()
+            if Path(path).exists()
+        }
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            'w', dir=self.cache_path.parent, delete=False
+        ) as f:
+            json.dump(cache, f)
+        os.replace(f.name, self.cache_path)
+        self.dirty = False
+
+    def disk_info(self, path, stat):
+        key = str(path)
+        entry = self.cache.get(key)
+        if entry and entry['stat'] == stat_key(stat):
+            return entry['info']
+
+        logger.debug('Inspecting %s ...', path)
+        header = qcow2.read_header(path)
+        info = None
+        if header:
+            allocated = header.allocated_bytes()
+            info = {
+                'virtual_size': header.size,
+                'backing_file': header.backing_file,
+                'allocated_in_layer': allocated,
+                'allocated_share': allocated / header.size if header.size
+                else 0,
+            }
+        self.cache[key] = {'stat': stat_key(stat), 'info': info}
+        self.dirty = True
+        return info
+
+    def usage(self, path):
+        usage = {'apparent': 0, 'allocated': 0, 'disks': {}}
+        for entry in iter_files(path):
+            stat = entry.stat(follow_symlinks=False)
+            usage['apparent'] += stat.st_size
+            usage['allocated'] += stat.st_blocks * 512
+            if entry.name.endswith('.qcow2'):
+                info = self.disk_info(Path(entry.path), stat)
+                if info:
+                    name = str(Path(entry.path).relative_to(path))
+                    usage['disks'][name] = info
+        self.save_cache()
+        return usage
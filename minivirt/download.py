@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 8 * 2**20
+CONNECTIONS = 4
+TIMEOUT = 60
+
+
+class DownloadStopped(Exception):
+    pass
+
+
+class RangeDownload:
+    def __init__(
+        self, url, path, part_size=PART_SIZE, connections=CONNECTIONS
+    ):
+        self.url = url
+        self.path = path
+        self.state_path = path.with_name(path.name + '.json')
+        self.part_size = part_size
+        self.connections = connections
+        self.lock = threading.Condition()
+        self.error = None
+        self.stopped = False
+
+    def probe(self):
+        request = Request(self.url, headers={'Range': 'bytes=0-0'})
+        with urlopen(request, timeout=TIMEOUT) as response:
+            headers = response.headers
+            validator = headers.get('ETag') or headers.get('Last-Modified')
+            content_range = headers.get('Content-Range')
+            if response.status == 206 and content_range:
+                return int(content_range.split('/')[-1]), validator
+        return None, validator
+
+    def load_state(self, size, validator):
+        state = {
+            'url': self.url,
+            'size': size,
+            'validator': validator,
+            'part_size': self.part_size,
+            'done': [],
+        }
+        try:
+            with self.state_path.open() as f:
+                old_state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            old_state = None
+
+        if old_state and self.path.exists() and all(
+            old_state.get(key) == state[key]
+            for key in ['url', 'size', 'validator', 'part_size']
+        ):
+            logger.info(
+                'Resuming download of %s (%d parts done)',
+                self.url, len(old_state['done']),
+            )
+            return old_state
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('wb') as f:
+            f.truncate(size)
+        self.save_state(state)
+        return state
+
+    def save_state(self, state):
+        tmp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def fetch_part(self, fd, number):
+        if self.stopped:
+            raise DownloadStopped
+        start = number * self.part_size
+        end = min(start + self.part_size, self.state['size']) - 1
+        t0 = time.monotonic()
+        request = Request(self.url, headers={'Range': f'bytes={start}-{end}'})
+        with urlopen(request, timeout=TIMEOUT) as response:
+            if response.status != 206:
+                raise RuntimeError(f'Range request for part {number} failed')
+            offset = start
+            for block in iter(lambda: response.read(2**20), b''):
+                if self.stopped:
+                    raise DownloadStopped
+                os.pwrite(fd, block, offset)
+                offset += len(block)
+        if offset != end + 1:
+            raise RuntimeError(f'Short read for part {number}')
+
+        elapsed = max(time.monotonic() - t0, 1e-6)
+        logger.debug(
+            'Downloaded part %d: %.1f MB/s',
+            number, (end + 1 - start) / 1e6 / elapsed,
+        )
+        with self.lock:
+            self.done.add(number)
+            self.state['done'] = sorted(self.done)
+            self.save_state(self.state)
+            self.lock.notify_all()
+
+    def run_part(self, fd, number):
+        try:
+            self.fetch_part(fd, number)
+        except DownloadStopped:
+            pass
+        except Exception as e:
+            with self.lock:
+                self.error = e
+                self.lock.notify_all()
+
+    def wait_for(self, number):
+        with self.lock:
+            while number not in self.done:
+                if self.error:
+                    raise self.error
+                self.lock.wait()
+
+    @contextmanager
+    def open(self):
+        size, validator = self.probe()
+        if size is None:
+            logger.info('Server does not support ranges, downloading %s '
+                        'in one stream', self.url)
+            with urlopen(self.url, timeout=TIMEOUT) as response:
+                yield response
+            return
+
+        self.state = self.load_state(size, validator)
+        self.done = set(self.state['done'])
+        count = -(-size // self.part_size)
+        missing = [n for n in range(count) if n not in self.done]
+
+        fd = os.open(self.path, os.O_RDWR)
+        executor = ThreadPoolExecutor(max_workers=self.connections)
+        try:
+            for number in missing:
+                executor.submit(self.run_part, fd, number)
+            yield PartReader(self, fd, size)
+
+        finally:
+            self.stopped = True
+            executor.shutdown(wait=True)
+            os.close(fd)
+
+    def discard(self):
+        self.path.unlink(missing_ok=True)
+        self.state_path.unlink(missing_ok=True)
+
+
+class PartReader:
+    def __init__(self, download, fd, size):
+        self.download = download
+        self.fd = fd
+        self.size = size
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.pos
+        size = min(size, self.size - self.pos)
+        if size <= 0:
+            return b''
+
+        part_size = self.download.part_size
+        number = self.pos // part_size
+        self.download.wait_for(number)
+        size = min(size, (number + 1) * part_size - self.pos)
+        data = os.pread(self.fd, size, self.pos)
+        self.pos += len(data)
+        return data
@@ -16,3 +16,19 @@ class WaitTimeout(RuntimeError):
 
 class RemoteNotFound(Exception):
     pass
+
+
+class ImageChecksumMismatch(RuntimeError):
+    pass
+
+
+class QMPError(RuntimeError):
+    pass
+
+
+class DownloadChecksumMismatch(RuntimeError):
+    pass
+
+
+class AgentError(RuntimeError):
+    pass
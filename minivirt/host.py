@@ -0,0 +1,74 @@
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+
+from . import qemu
+from .configs import Config
+
+logger = logging.getLogger(__name__)
+
+MAX_DEFAULT_CPUS = 4
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def probe_file_options(directory, options):
+    # qemu-img refuses to open a file with options that QEMU or the
+    # filesystem can't honour, e.g. O_DIRECT on tmpfs, or io_uring when
+    # QEMU is built without it.
+    with tempfile.NamedTemporaryFile(dir=directory) as f:
+        filename = f.name.replace(',', ',,')
+        result = subprocess.run(
+            [
+                'qemu-img', 'info', '--image-opts',
+                f'driver=file,filename={filename},{options}',
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    return result.returncode == 0
+
+
+class Host:
+    # What the host supports, probed once per QEMU version, kernel and
+    # filesystem, and cached in `{db}/host.json`.
+
+    def __init__(self, db):
+        self.db = db
+        self.config = Config(db.path / 'host.json')
+
+    def default_cpus(self):
+        return min(cpu_count(), MAX_DEFAULT_CPUS)
+
+    def probe(self, directory):
+        key = ' '.join([
+            str(qemu.get_version()),
+            platform.release(),
+            str(os.stat(directory).st_dev),
+        ])
+        if self.config.get('key') == key:
+            return self.config.content
+
+        logger.info('Probing host capabilities ...')
+        direct_io = probe_file_options(directory, 'cache.direct=on')
+        if probe_file_options(directory, 'aio=io_uring'):
+            aio = 'io_uring'
+        elif direct_io and probe_file_options(
+            directory, 'aio=native,cache.direct=on'
+        ):
+            aio = 'native'
+        else:
+            aio = 'threads'
+
+        self.config.content.clear()
+        self.config.update(key=key, direct_io=direct_io, aio=aio)
+        self.config.save()
+        return self.config.content
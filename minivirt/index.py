@@ -0,0 +1,149 @@
+import sqlite3
+from contextlib import closing, contextmanager
+
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS images (
+        id TEXT PRIMARY KEY,
+        parent_id TEXT
+    );
+    CREATE TABLE IF NOT EXISTS tags (
+        name TEXT PRIMARY KEY,
+        image_id TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS tags_image_id ON tags (image_id);
+    CREATE TABLE IF NOT EXISTS vms (
+        name TEXT PRIMARY KEY,
+        image_id TEXT
+    );
+    CREATE INDEX IF NOT EXISTS vms_image_id ON vms (image_id);
+'''
+
+TABLES = ['images', 'tags', 'vms']
+
+
+class Index:
+    def __init__(self, path):
+        self.path = path
+
+    def needs_rebuild(self):
+        if not self.path.exists():
+            return True
+        with self.connect() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+        return version != SCHEMA_VERSION
+
+    @contextmanager
+    def connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            with conn:
+                conn.executescript(SCHEMA)
+                yield conn
+
+    def _column(self, query, *args):
+        with self.connect() as conn:
+            return [row[0] for row in conn.execute(query, args)]
+
+    def add_image(self, image_id, parent_id=None):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO images (id, parent_id) VALUES (?, ?)',
+                (image_id, parent_id),
+            )
+
+    def remove_image(self, image_id):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM images WHERE id = ?', (image_id,))
+
+    def image_ids(self):
+        return self._column('SELECT id FROM images ORDER BY id')
+
+    def set_tag(self, name, image_id):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO tags (name, image_id) VALUES (?, ?)',
+                (name, image_id),
+            )
+
+    def remove_tag(self, name):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM tags WHERE name = ?', (name,))
+
+    def tags(self, image_id=None):
+        query = 'SELECT name, image_id FROM tags'
+        args = ()
+        if image_id is not None:
+            query += ' WHERE image_id = ?'
+            args = (image_id,)
+        with self.connect() as conn:
+            return conn.execute(query + ' ORDER BY name', args).fetchall()
+
+    def add_vm(self, name, image_id):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO vms (name, image_id) VALUES (?, ?)',
+                (name, image_id),
+            )
+
+    def remove_vm(self, name):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM vms WHERE name = ?', (name,))
+
+    def vms(self):
+        with self.connect() as conn:
+            return conn.execute(
+                'SELECT name, image_id FROM vms ORDER BY name'
+            ).fetchall()
+
+    def images(self):
+        with self.connect() as conn:
+            return conn.execute(
+                'SELECT id, parent_id FROM images ORDER BY id'
+            ).fetchall()
+
+    def used_image_ids(self):
+        return set(self._column('''
+            WITH RECURSIVE used (id) AS (
+                SELECT image_id FROM tags
+                UNION
+                SELECT image_id FROM vms WHERE image_id IS NOT NULL
+                UNION
+                SELECT images.parent_id FROM images
+                    JOIN used ON images.id = used.id
+                    WHERE images.parent_id IS NOT NULL
+            )
+            SELECT id FROM used
+        '''))
+
+    def replace(self, images, tags, vms):
+        with self.connect() as conn:
+            # Rebuild in a single transaction, so that other processes never
+            # see a partial index. executescript() would commit halfway.
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                for table in TABLES:
+                    if version == SCHEMA_VERSION:
+                        conn.execute(f'DELETE FROM {table}')
+                    else:
+                        conn.execute(f'DROP TABLE {table}')
+                if version != SCHEMA_VERSION:
+                    for statement in filter(str.strip, SCHEMA.split(';')):
+                        conn.execute(statement)
+                    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                conn.executemany(
+                    'INSERT INTO images (id, parent_id) VALUES (?, ?)', images
+                )
+                conn.executemany(
+                    'INSERT INTO tags (name, image_id) VALUES (?, ?)', tags
+                )
+                conn.executemany(
+                    'INSERT INTO vms (name, image_id) VALUES (?, ?)', vms
+                )
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
@@ -0,0 +1,233 @@
+import fcntl
+import logging
+import os
+import secrets
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+from .configs import Config
+from .exceptions import WaitTimeout
+from .vms import VM
+
+logger = logging.getLogger(__name__)
+
+PREFIX = '_pool-'
+MEMORY = 1024
+MAX_VMS = 4
+BOOT_TIMEOUT = 120
+SAMPLES = 100
+
+
+class Pool:
+    # Each pool VM runs in snapshot mode. Once it's booted, the filler
+    # creates an `idle` marker in its directory; whoever renames the marker
+    # to `claimed` first owns the VM.
+
+    def __init__(self, db):
+        self.db = db
+        self.path = db.path / 'pool'
+        self.config = Config(self.path / 'config.json')
+
+    @property
+    def max_vms(self):
+        return self.config.get('max_vms', MAX_VMS)
+
+    def targets(self):
+        return self.config.get('images', {})
+
+    def set_target(self, image, size=None, memory=None):
+        # Settings that are not given keep their current value.
+        targets = self.config.setdefault('images', {})
+        current = targets.get(image.name, {})
+        if size is None:
+            size = current.get('size')
+            if size is None:
+                raise ValueError(f'No pool size set for {image}')
+        if size:
+            targets[image.name] = {
+                'size': size,
+                'memory': memory or current.get('memory', MEMORY),
+            }
+        else:
+            targets.pop(image.name, None)
+        self.config.save()
+
+    def iter_vms(self, image_id=None):
+        for vm in self.db.iter_vms():
+            if not vm.name.startswith(PREFIX):
+                continue
+            if image_id and vm.config.get('image') != image_id:
+                continue
+            yield vm
+
+    def is_idle(self, vm):
+        return (vm.path / 'idle').exists()
+
+    def claim(self, image, memory):
+        for vm in self.iter_vms(image.name):
+            if str(vm.config.get('memory')) != str(memory):
+                continue
+            try:
+                os.rename(vm.path / 'idle', vm.path / 'claimed')
+            except FileNotFoundError:
+                continue
+
+            if vm.is_running:
+                logger.info('Claimed %s from the pool', vm)
+                return vm
+
+            logger.warning('Pool VM %s is not running, destroying it', vm)
+            vm.destroy()
+
+    def boot(self, image, memory):
+        name = f'{PREFIX}{image.short_name}-{secrets.token_hex(4)}'
+        vm = VM.create(self.db, name, image=image, memory=memory)
+        try:
+            vm.start(
+                daemon=True,
+                snapshot=True,
+                wait_for_ssh=BOOT_TIMEOUT,
+                statusline=False,
+            )
+            vm.disconnect_qmp()
+        except BaseException:
+            vm.destroy()
+            raise
+        return vm
+
+    @contextmanager
+    def lock(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with (self.path / 'fill.lock').open('a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def fill(self):
+        with self.lock() as locked:
+            if not locked:
+                logger.info('The pool is already being filled')
+                return
+
+            # Only the filler, which holds the lock, creates pool VMs, so a
+            # VM without a marker is left over from a filler that died.
+            for vm in self.iter_vms():
+                if not (
+                    self.is_idle(vm) or (vm.path / 'claimed').exists()
+                ):
+                    logger.warning('Destroying unfinished pool VM %s', vm)
+                    vm.destroy()
+
+            for image_id, target in self.targets().items():
+                image = self.db.get_image(image_id)
+                while True:
+                    vms = list(self.iter_vms())
+                    count = sum(
+                        1 for vm in vms
+                        if vm.config.get('image') == image_id
+                        and not (vm.path / 'claimed').exists()
+                    )
+                    if count >= target['size'] or len(vms) >= self.max_vms:
+                        break
+
+                    logger.info('Booting a pool VM for %s ...', image)
+                    try:
+                        vm = self.boot(image, target['memory'])
+                    except WaitTimeout:
+                        logger.warning('Pool VM for %s did not boot', image)
+                        break
+                    try:
+                        (vm.path / 'idle').touch()
+                    except BaseException:
+                        vm.destroy()
+                        raise
+
+    def fill_in_background(self):
+        if not self.targets():
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        with (self.path / 'fill.log').open('a') as log:
+            subprocess.Popen(
+                [sys.executable, '-m', 'minivirt', '-v', 'pool', 'fill'],
+                env=dict(os.environ, MINIVIRT_DB_PATH=str(self.db.path)),
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=log,
+                start_new_session=True,
+            )
+
+    def drain(self):
+        for vm in self.iter_vms():
+            try:
+                os.rename(vm.path / 'idle', vm.path / 'claimed')
+            except FileNotFoundError:
+                continue
+            logger.info('Destroying %s', vm)
+            vm.destroy()
+
+    @contextmanager
+    def run(
+        self, image, memory=MEMORY, ports=(), wait_for_ssh=60, **options
+    ):
+        t0 = time.monotonic()
+        vm = None
+        # Pool VMs have no forwarded ports and run with default options.
+        if not ports and not any(options.values()):
+            vm = self.claim(image, memory)
+
+        if vm is not None:
+            self.record('hits', time.monotonic() - t0)
+            try:
+                yield vm
+            finally:
+                vm.destroy()
+                self.fill_in_background()
+            return
+
+        name = f'{image.short_name}-{secrets.token_hex(8)}'
+        vm = VM.create(
+            self.db, name, image=image, memory=memory, ports=ports, **options
+        )
+        try:
+            with vm.run(wait_for_ssh=wait_for_ssh):
+                self.record('misses', time.monotonic() - t0)
+                yield vm
+        finally:
+            vm.destroy()
+            self.fill_in_background()
+
+    def record(self, counter, seconds):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with (self.path / 'stats.lock').open('a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            stats = Config(self.path / 'stats.json')
+            stats[counter] = stats.get(counter, 0) + 1
+            samples = stats.get(f'{counter}_seconds', []) + [seconds]
+            stats[f'{counter}_seconds'] = samples[-SAMPLES:]
+            stats.save()
+
+    def stats(self):
+        stats = Config(self.path / 'stats.json')
+        rv = {
+            'hits': stats.get('hits', 0),
+            'misses': stats.get('misses', 0),
+            'vms': {},
+        }
+        for counter in ['hits', 'misses']:
+            samples = stats.get(f'{counter}_seconds')
+            if samples:
+                rv[f'{counter}_latency'] = {
+                    'median': statistics.median(samples),
+                    'max': max(samples),
+                }
+        for vm in self.iter_vms():
+            state = 'idle' if self.is_idle(vm) else 'busy'
+            counts = rv['vms'].setdefault(vm.config.get('image'), {})
+            counts[state] = counts.get(state, 0) + 1
+        return rv
@@ -0,0 +1,75 @@
+import struct
+
+MAGIC = b'QFI\xfb'
+HEADER_FORMAT = '>4sIQIIQIIQ'
+V3_FORMAT = '>QQQII'
+OFFSET_MASK = 0x00fffffffffffe00
+INCOMPAT_EXTENDED_L2 = 1 << 4
+
+
+class Header:
+    def __init__(self, path):
+        self.path = path
+        with path.open('rb') as f:
+            raw = f.read(104)
+            (
+                _, self.version,
+                backing_file_offset, backing_file_size,
+                self.cluster_bits, self.size, _,
+                self.l1_size, self.l1_table_offset,
+            ) = struct.unpack_from(HEADER_FORMAT, raw)
+
+            self.incompatible_features = 0
+            if self.version >= 3:
+                self.incompatible_features = struct.unpack_from(
+                    V3_FORMAT, raw, 72
+                )[0]
+
+            self.backing_file = None
+            if backing_file_offset:
+                f.seek(backing_file_offset)
+                self.backing_file = f.read(backing_file_size).decode('utf8')
+
+    @property
+    def cluster_size(self):
+        return 1 << self.cluster_bits
+
+    @property
+    def l2_entry_size(self):
+        if self.incompatible_features & INCOMPAT_EXTENDED_L2:
+            return 16
+        return 8
+
+    def count_allocated_clusters(self):
+        count = 0
+        with self.path.open('rb') as f:
+            f.seek(self.l1_table_offset)
+            l1 = struct.unpack(
+                f'>{self.l1_size}Q', f.read(self.l1_size * 8)
+            )
+            entries_per_table = self.cluster_size // self.l2_entry_size
+            step = self.l2_entry_size // 8
+            for l1_entry in l1:
+                l2_offset = l1_entry & OFFSET_MASK
+                if not l2_offset:
+                    continue
+                f.seek(l2_offset)
+                l2 = struct.unpack(
+                    f'>{entries_per_table * step}Q',
+                    f.read(self.cluster_size),
+                )
+                count += sum(1 for entry in l2[::step] if entry)
+        return count
+
+    def allocated_bytes(self):
+        return self.count_allocated_clusters() * self.cluster_size
+
+
+def is_qcow2(path):
+    with path.open('rb') as f:
+        return f.read(4) == MAGIC
+
+
+def read_header(path):
+    if is_qcow2(path):
+        return Header(path)
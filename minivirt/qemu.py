@@ -1,10 +1,10 @@
 import fcntl
-import json
 import logging
-import socket
+import re
 import subprocess
+from functools import lru_cache
 
-from .utils import waitfor
+from .qmp import QMP  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
@@ -79,6 +79,13 @@ def get_display_args():
     ]
 
 
+@lru_cache()
+def get_version():
+    out = subprocess.check_output([binary, '--version']).decode('utf8')
+    m = re.search(r'version (\S+)', out)
+    return m and m.group(1)
+
+
 def doctor():
     assert subprocess.check_output(
         [command_prefix[0], '--version']
@@ -93,33 +100,3 @@ def doctor():
         KVM_API_VERSION = 12
         with open('/dev/kvm') as kvm:
             assert fcntl.ioctl(kvm, KVM_GET_API_VERSION) == KVM_API_VERSION
-
-
-class QMP:
-    def __init__(self, path):
-        logger.debug('Waiting for QMP socket to show up ...')
-        waitfor(path.exists)
-        logger.debug('Connecting to QMP socket ...')
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.connect(str(path))
-        self.reader = self.sock.makefile(encoding='utf8')
-        logger.debug('Connection to QMP estabilished.')
-        self.initial_message = self.recv()
-        self.send({'execute': 'qmp_capabilities'})
-        assert 'return' in self.recv()
-        logger.debug('Talking to QEMU %r', self.initial_message)
-
-    def send(self, msg):
-        logger.debug('Sending QMP message: %s.', msg)
-        return self.sock.sendall(json.dumps(msg).encode('utf8'))
-
-    def recv(self):
-        msg = json.loads(self.reader.readline())
-        logger.debug('Received QMP message: %s.', msg)
-        return msg
-
-    def quit(self):
-        self.send({'execute': 'quit'})
-
-    def poweroff(self):
-        self.send({'execute': 'system_powerdown'})
@@ -0,0 +1,292 @@
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from .exceptions import QMPError, WaitTimeout
+from .utils import waitfor
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 5
+COMMAND_TIMEOUT = 60
+
+
+class AsyncQMP:
+    def __init__(self):
+        self.ids = itertools.count()
+        self.pending = {}
+        self.subscribers = []
+        self.initial_message = None
+        self.closed = None
+
+    async def connect(self, path, timeout=CONNECT_TIMEOUT):
+        self.closed = asyncio.Event()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(str(path), limit=2**24), timeout
+        )
+        # If another client holds the monitor, QEMU doesn't greet us.
+        line = await asyncio.wait_for(self.reader.readline(), timeout)
+        if not line:
+            raise ConnectionResetError('QEMU is gone')
+        self.initial_message = json.loads(line)
+        self.read_task = asyncio.ensure_future(self.read_loop())
+        await self.execute('qmp_capabilities')
+        logger.debug('Talking to QEMU %r', self.initial_message)
+
+    async def read_loop(self):
+        try:
+            async for line in self.reader:
+                msg = json.loads(line)
+                logger.debug('Received QMP message: %s.', msg)
+                if 'event' in msg:
+                    for names, queue in self.subscribers:
+                        if not names or msg['event'] in names:
+                            queue.put_nowait(msg)
+                else:
+                    # Commands that timed out are no longer pending.
+                    future = self.pending.pop(msg.get('id'), None)
+                    if future is not None and not future.done():
+                        future.set_result(msg)
+
+        finally:
+            self.closed.set()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError('QEMU is gone'))
+            self.pending.clear()
+            for _, queue in self.subscribers:
+                queue.put_nowait(None)
+
+    async def execute(self, command, **arguments):
+        if self.closed.is_set():
+            raise ConnectionResetError('QEMU is gone')
+        msg = {'execute': command, 'id': next(self.ids)}
+        if arguments:
+            msg['arguments'] = arguments
+        future = asyncio.get_event_loop().create_future()
+        self.pending[msg['id']] = future
+        try:
+            logger.debug('Sending QMP message: %s.', msg)
+            self.writer.write(json.dumps(msg).encode('utf8') + b'\n')
+            await self.writer.drain()
+            reply = await future
+        finally:
+            # Also when cancelled, so that a late reply is ignored.
+            self.pending.pop(msg['id'], None)
+        if 'error' in reply:
+            raise QMPError(reply['error']['desc'])
+        return reply['return']
+
+    def subscribe(self, *names):
+        queue = asyncio.Queue()
+        self.subscribers.append((set(names), queue))
+        if self.closed.is_set():
+            queue.put_nowait(None)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers = [
+            item for item in self.subscribers if item[1] is not queue
+        ]
+
+    async def events(self, *names):
+        queue = self.subscribe(*names)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+
+        finally:
+            self.unsubscribe(queue)
+
+    async def wait_closed(self):
+        await self.closed.wait()
+
+    async def close(self):
+        self.writer.close()
+        await self.closed.wait()
+
+
+class EventLoop:
+    # The sync API runs every client on one background event loop.
+
+    lock = threading.Lock()
+    loop = None
+
+    @classmethod
+    def get(cls):
+        with cls.lock:
+            if cls.loop is None:
+                cls.loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=cls.loop.run_forever, daemon=True
+                ).start()
+            return cls.loop
+
+
+def run(coro, timeout=COMMAND_TIMEOUT):
+    future = asyncio.run_coroutine_threadsafe(coro, EventLoop.get())
+    try:
+        return future.result(timeout)
+    except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+        future.cancel()
+        raise WaitTimeout('Timeout expired')
+
+
+class Subscription:
+    def __init__(self, qmp, names):
+        self.qmp = qmp
+
+        async def subscribe():
+            return qmp.client.subscribe(*names)
+
+        self.queue = run(subscribe())
+
+    def get(self, timeout=COMMAND_TIMEOUT):
+        event = run(asyncio.wait_for(self.queue.get(), timeout), None)
+        if event is None:
+            raise ConnectionResetError('QEMU is gone')
+        return event
+
+    def close(self):
+        def close():
+            self.qmp.client.unsubscribe(self.queue)
+            # Wake up whoever is waiting for an event.
+            self.queue.put_nowait(None)
+
+        EventLoop.get().call_soon_threadsafe(close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class QMP:
+    def __init__(self, path, timeout=CONNECT_TIMEOUT):
+        logger.debug('Waiting for QMP socket to show up ...')
+        waitfor(path.exists)
+        self.client = AsyncQMP()
+        # Unix socket paths are limited to ~100 characters, so connect
+        # through a short symlink.
+        with tempfile.TemporaryDirectory() as tmp:
+            sock_path = Path(tmp) / 'sock'
+            sock_path.symlink_to(path)
+            run(self.client.connect(sock_path, timeout), None)
+        logger.debug('Connection to QMP estabilished.')
+
+    @property
+    def initial_message(self):
+        return self.client.initial_message
+
+    @property
+    def is_closed(self):
+        return self.client.closed.is_set()
+
+    def execute(self, command, timeout=COMMAND_TIMEOUT, **arguments):
+        return run(self.client.execute(command, **arguments), timeout)
+
+    def execute_many(self, commands, timeout=COMMAND_TIMEOUT):
+        # Send all the commands at once and wait for all the replies.
+        async def execute_all():
+            return await asyncio.gather(*(
+                self.client.execute(command, **arguments)
+                for command, arguments in commands
+            ))
+
+        return run(execute_all(), timeout)
+
+    def subscribe(self, *names):
+        return Subscription(self, names)
+
+    def wait_closed(self, timeout=None):
+        run(self.client.wait_closed(), timeout)
+
+    def close(self):
+        run(self.client.close())
+
+    def migrate(self, uri, timeout=300):
+        self.execute('migrate', uri=uri)
+
+        def migration_completed():
+            status = self.execute('query-migrate').get('status')
+            if status in ['failed', 'cancelled']:
+                raise QMPError(f'Migration {status}')
+            return status == 'completed'
+
+        waitfor(migration_completed, timeout=timeout)
+
+    def set_migrate_capability(self, capability, state=True):
+        self.execute(
+            'migrate-set-capabilities',
+            capabilities=[{'capability': capability, 'state': state}],
+        )
+
+    def quit(self):
+        try:
+            self.execute('quit')
+        except ConnectionResetError:
+            # QEMU may exit before its reply gets to us.
+            pass
+
+    def poweroff(self):
+        self.execute('system_powerdown')
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def reset_after_fork():
+    # The event loop's thread doesn't survive a fork.
+    EventLoop.loop = None
+    sessions.clear()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def session(path):
+    # Reuse one connection per socket, since QEMU only talks to one client
+    # at a time.
+    key = str(Path(path).resolve())
+    with sessions_lock:
+        qmp = sessions.get(key)
+        if qmp is None or qmp.is_closed:
+            qmp = sessions[key] = QMP(path)
+        return qmp
+
+
+@contextmanager
+def borrow(path, timeout=CONNECT_TIMEOUT):
+    # Use this process's session if it has one, otherwise a connection
+    # that's closed right after, so others can talk to QEMU.
+    key = str(Path(path).resolve())
+    with sessions_lock:
+        qmp = sessions.get(key)
+    if qmp is not None and not qmp.is_closed:
+        yield qmp
+        return
+    qmp = QMP(path, timeout=timeout)
+    try:
+        yield qmp
+    finally:
+        qmp.close()
+
+
+def close_session(path):
+    key = str(Path(path).resolve())
+    with sessions_lock:
+        qmp = sessions.pop(key, None)
+    if qmp is not None and not qmp.is_closed:
+        qmp.close()
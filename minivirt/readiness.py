@@ -0,0 +1,110 @@
+import logging
+import re
+import threading
+import time
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# While waiting for a signal, probe the ssh banner this often, in case the
+# signal never comes.
+FALLBACK_INTERVAL = 5
+
+
+class Readiness:
+    # Works out when a booting VM is ready, and how long each phase took.
+    # The guest tells us it's up by printing the image's `ready_marker` on
+    # the serial console, or by opening the guest agent's channel. The ssh
+    # banner is probed once that happens, or right away if the image offers
+    # neither signal. If the signal doesn't come, e.g. because the marker
+    # no longer matches what the guest prints, the banner is what tells.
+
+    def __init__(self, vm, statusline, resumed=False):
+        self.vm = vm
+        self.statusline = statusline
+        self.last = time.monotonic()
+        self.timings = {}
+        self.signal = threading.Event()
+        self.subscription = None
+
+        # A guest resumed from saved state has booted already.
+        marker = None if resumed else vm.config.get('ready_marker')
+        self.marker = marker and re.compile(marker)
+        if self.marker:
+            statusline.add_listener(self.on_serial_line)
+        self.agent = not resumed and vm.config.get('agent')
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.timings[phase] = now - self.last
+        self.last = now
+
+    def on_serial_line(self, line):
+        if self.marker.search(line):
+            logger.debug('Found the ready marker on the serial console')
+            self.signal.set()
+
+    def watch_agent(self):
+        self.subscription = self.vm.connect_qmp().subscribe('VSERPORT_CHANGE')
+        self.mark('qemu')
+        threading.Thread(target=self.wait_for_agent, daemon=True).start()
+
+    def stop_watching(self):
+        # QEMU only talks to one QMP client, so let go of it as soon as
+        # possible.
+        if self.subscription:
+            self.subscription.close()
+            self.subscription = None
+            self.vm.disconnect_qmp()
+
+    def wait_for_agent(self):
+        try:
+            while True:
+                event = self.subscription.get(timeout=None)
+                if event['data'].get('open'):
+                    logger.debug('The guest agent is up')
+                    self.signal.set()
+                    return
+        except ConnectionResetError:
+            pass
+
+    def wait_for_signal(self, ssh_port, expires):
+        while time.monotonic() < expires:
+            interval = min(FALLBACK_INTERVAL, expires - time.monotonic())
+            if self.signal.wait(max(interval, 0)):
+                self.mark('boot')
+                return
+            if utils.probe_ssh(ssh_port):
+                logger.warning('%s is up, but sent no ready signal', self.vm)
+                return
+
+    def wait(self, ssh_port, timeout):
+        expires = time.monotonic() + timeout
+        try:
+            if self.agent:
+                self.watch_agent()
+            if self.marker or self.agent:
+                self.wait_for_signal(ssh_port, expires)
+        finally:
+            self.stop_watching()
+
+        utils.wait_for_ssh(ssh_port, max(expires - time.monotonic(), 0))
+        self.mark('ssh')
+        logger.info(
+            '%s is ready in %.2fs (%s)',
+            self.vm,
+            sum(self.timings.values()),
+            ', '.join(f'{k} {v:.2f}s' for k, v in self.timings.items()),
+        )
+
+    def close(self):
+        if self.marker:
+            self.statusline.remove_listener(self.on_serial_line)
+        self.stop_watching()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,29 +1,131 @@
+import json
 import logging
 import os
-import subprocess
 import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.error import HTTPError
 from urllib.request import urlopen
 
 import boto3
 import botocore.exceptions
 import click
 
+from . import archive, chunks
 from .configs import Config
-from .exceptions import RemoteNotFound
+from .download import RangeDownload
+from .exceptions import ImageChecksumMismatch, RemoteNotFound
 
 logger = logging.getLogger(__name__)
 
+PART_SIZE = 16 * 2**20
+PARTS_IN_FLIGHT = 4
+CHUNKS_IN_FLIGHT = 8
+
+
+class MultipartUpload:
+    def __init__(self, bucket, key, part_size, parts_in_flight):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.pending = bytearray()
+        self.parts = []
+        self.slots = threading.BoundedSemaphore(parts_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=parts_in_flight)
+        self.upload_id = bucket.s3.create_multipart_upload(
+            Bucket=bucket.name, Key=key
+        )['UploadId']
+
+    def write(self, data):
+        self.pending += data
+        while len(self.pending) >= self.part_size:
+            self.submit(bytes(self.pending[:self.part_size]))
+            del self.pending[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def submit(self, data):
+        for part in self.parts:
+            if part.done() and part.exception():
+                raise part.exception()
+
+        # Wait for a free slot, so we only hold a bounded number of parts
+        # in memory.
+        self.slots.acquire()
+        number = len(self.parts) + 1
+        self.parts.append(self.executor.submit(self.upload_part, number, data))
+
+    def upload_part(self, number, data):
+        try:
+            t0 = time.monotonic()
+            response = self.bucket.s3.upload_part(
+                Bucket=self.bucket.name,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=data,
+            )
+            elapsed = max(time.monotonic() - t0, 1e-6)
+            logger.info(
+                'Uploaded part %d of %s: %.1f MB in %.1fs, %.1f MB/s',
+                number, self.key, len(data) / 1e6, elapsed,
+                len(data) / 1e6 / elapsed,
+            )
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        finally:
+            self.slots.release()
+
+    def complete(self):
+        if self.pending or not self.parts:
+            self.submit(bytes(self.pending))
+            self.pending.clear()
+        parts = [part.result() for part in self.parts]
+        self.bucket.s3.complete_multipart_upload(
+            Bucket=self.bucket.name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts},
+        )
+        self.executor.shutdown()
+
+    def abort(self):
+        self.executor.shutdown(wait=True)
+        self.bucket.s3.abort_multipart_upload(
+            Bucket=self.bucket.name, Key=self.key, UploadId=self.upload_id
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+
+        try:
+            self.complete()
+        except BaseException:
+            self.abort()
+            raise
+
 
 class S3Bucket:
-    def __init__(self, name):
+    def __init__(self, name, s3=None):
         self.name = name
-        self.s3 = boto3.client(
-            's3',
-            endpoint_url=os.environ.get('AWS_ENDPOINT_URL'),
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-        )
+        if s3 is None:
+            s3 = boto3.client(
+                's3',
+                endpoint_url=os.environ.get('AWS_ENDPOINT_URL'),
+                aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            )
+        self.s3 = s3
 
     def exists(self, key):
         try:
@@ -37,10 +139,33 @@ class S3Bucket:
 
         return True
 
+    def keys(self, prefix):
+        # Listing returns up to 1000 keys per request, instead of one HEAD
+        # request per key.
+        kwargs = {}
+        while True:
+            page = self.s3.list_objects_v2(
+                Bucket=self.name, Prefix=prefix, **kwargs
+            )
+            for item in page.get('Contents', []):
+                yield item['Key']
+            if not page.get('IsTruncated'):
+                return
+            kwargs = {'ContinuationToken': page['NextContinuationToken']}
+
     def upload(self, path, key):
         logger.info('Uploading to %s ...', key)
         self.s3.upload_file(str(path), self.name, key)
 
+    def put(self, key, data):
+        self.s3.put_object(Bucket=self.name, Key=key, Body=data)
+
+    def upload_stream(
+        self, key, part_size=PART_SIZE, parts_in_flight=PARTS_IN_FLIGHT
+    ):
+        logger.info('Uploading to %s ...', key)
+        return MultipartUpload(self, key, part_size, parts_in_flight)
+
 
 class Remotes:
     def __init__(self, db):
@@ -65,43 +190,177 @@ class Remote:
         self.name = name
         self.url = url
 
-    def push(self, image, tag):
+    def push(self, image, tag, chunked=False):
         bucket = S3Bucket(self.url.split('/')[-1])
-        image_key = f'images/{image.name}.tgz'
         tag_key = f'tags/{tag}'
+        push_image = self.push_chunks if chunked else self.push_image
 
-        with tempfile.TemporaryDirectory() as tmp:
-            if not bucket.exists(image_key):
-                tar_path = Path(tmp) / 'image.tar'
-                tgz_path = Path(tmp) / 'image.tar.gz'
-                with tar_path.open('wb') as f:
-                    self.db.save(image.name, f)
-
-                subprocess.check_call(['gzip', '-1', tar_path])
-
-                bucket.upload(tgz_path, image_key)
+        for ancestor in reversed(list(image.iter_ancestors())):
+            push_image(bucket, ancestor)
+        push_image(bucket, image)
 
+        with tempfile.TemporaryDirectory() as tmp:
             tag_path = Path(tmp) / 'tag'
             with tag_path.open('w') as f:
                 f.write(image.name)
 
             bucket.upload(tag_path, tag_key)
 
+    def push_image(self, bucket, image):
+        image_key = f'images/{image.name}.tgz'
+        if bucket.exists(image_key):
+            return
+
+        with bucket.upload_stream(image_key) as upload:
+            self.db.save(image.name, upload, compression='gzip')
+
+    def push_chunks(self, bucket, image):
+        manifest_key = f'manifests/{image.name}.json'
+        if bucket.exists(manifest_key):
+            return
+
+        cdc = image.get_cdc()
+        digests = sorted({
+            digest for file_chunks in cdc.values()
+            for digest, _ in file_chunks
+        })
+
+        existing = set(bucket.keys('chunks/'))
+        missing = {
+            digest for digest in digests
+            if f'chunks/{digest}' not in existing
+        }
+        logger.info(
+            'Uploading %d of %d chunks for %s ...',
+            len(missing), len(digests), image,
+        )
+
+        with ThreadPoolExecutor(max_workers=CHUNKS_IN_FLIGHT) as executor:
+            pending = deque()
+            for name, file_chunks in cdc.items():
+                with (image.path / name).open('rb') as f:
+                    for digest, size in file_chunks:
+                        data = f.read(size)
+                        if digest not in missing:
+                            continue
+                        missing.discard(digest)
+                        # Keep a bounded number of chunks in memory.
+                        if len(pending) >= CHUNKS_IN_FLIGHT * 2:
+                            pending.popleft().result()
+                        pending.append(executor.submit(
+                            bucket.put,
+                            f'chunks/{digest}',
+                            chunks.compress(data),
+                        ))
+
+            for future in pending:
+                future.result()
+
+        # The manifest goes last, so a pull never sees missing chunks.
+        bucket.put(manifest_key, json.dumps({'files': cdc}).encode('utf8'))
+
     def pull(self, tag, local_tag):
         with urlopen(f'{self.url}/tags/{tag}') as f:
             image_id = f.read().decode('utf8')
 
+        self.pull_image(image_id).tag(local_tag)
+
+    def pull_image(self, image_id):
         if self.db.image_path(image_id).exists():
             logger.info('Image %s already exists', image_id)
-            self.db.get_image(image_id).tag(local_tag)
-            return
+            return self.db.get_image(image_id)
+
+        try:
+            with urlopen(f'{self.url}/manifests/{image_id}.json') as f:
+                manifest = json.load(f)
+
+        except HTTPError as e:
+            if e.code not in (403, 404):
+                raise
+
+        else:
+            return self.pull_chunks(image_id, manifest)
 
         image_url = f'{self.url}/images/{image_id}.tgz'
-        logger.info('Downloading %s from %s ...', local_tag, image_url)
-        with subprocess.Popen(
-            ['curl', image_url], stdout=subprocess.PIPE
-        ) as p:
-            self.db.load(local_tag, stdin=p.stdout, gzip=True)
+        logger.info('Downloading %s from %s ...', image_id, image_url)
+        download = RangeDownload(
+            image_url, self.db.path / 'downloads' / f'{image_id}.tgz'
+        )
+        try:
+            with download.open() as f:
+                image = self.db.load(
+                    None,
+                    stdin=f,
+                    fetch_parent=self.pull_image,
+                    expected_id=image_id,
+                )
+
+        except ImageChecksumMismatch:
+            download.discard()
+            raise
+
+        download.discard()
+        return image
+
+    def pull_chunks(self, image_id, manifest):
+        files = manifest['files']
+        local = self.db.local_chunks()
+        fetched = reused = 0
+
+        with self.db.create_image(image_id) as creator:
+            with creator.hashing() as open_hasher:
+                # The config comes first, it decides the checksum scheme.
+                for name in sorted(files, key=lambda n: n != 'config.json'):
+                    hasher = open_hasher(name)
+                    path = archive.member_path(creator.path, name)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    with path.open('wb') as f:
+                        for data, is_local in self.iter_chunks(
+                            files[name], local
+                        ):
+                            archive.write_sparse(f, data)
+                            hasher.update(data)
+                            if is_local:
+                                reused += len(data)
+                            else:
+                                fetched += len(data)
+                        f.truncate()
+
+            creator.cdc = files
+            self.db.require_parent(creator.path, self.pull_image)
+
+        logger.info(
+            'Pulled %s: fetched %.1f MB, reused %.1f MB from local images',
+            image_id, fetched / 1e6, reused / 1e6,
+        )
+        return creator.image
+
+    def iter_chunks(self, file_chunks, local):
+        with ThreadPoolExecutor(max_workers=CHUNKS_IN_FLIGHT) as executor:
+            pending = deque()
+            for digest, _ in file_chunks:
+                if len(pending) >= CHUNKS_IN_FLIGHT * 2:
+                    yield pending.popleft().result()
+                pending.append(
+                    executor.submit(self.get_chunk, digest, local)
+                )
+            while pending:
+                yield pending.popleft().result()
+
+    def get_chunk(self, digest, local):
+        if digest in local:
+            path, offset, size = local[digest]
+            try:
+                with path.open('rb') as f:
+                    data = os.pread(f.fileno(), size, offset)
+            except FileNotFoundError:
+                pass
+            else:
+                if chunks.digest(data) == digest:
+                    return data, True
+
+        with urlopen(f'{self.url}/chunks/{digest}') as f:
+            return chunks.decompress(f.read(), digest), False
 
 
 @click.group()
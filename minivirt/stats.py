@@ -0,0 +1,72 @@
+import fcntl
+import json
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(samples, p):
+    # Nearest-rank percentile of sorted samples.
+    rank = max(math.ceil(p / 100 * len(samples)), 1)
+    return samples[rank - 1]
+
+
+class History:
+    # An append-only log of VM lifecycle timings, one JSON object per line.
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, event, phases, **fields):
+        record = dict(time=time.time(), event=event, phases=phases, **fields)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('a') as f:
+            # Lines are small, but lock anyway so that concurrent writers
+            # don't interleave.
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + '\n')
+
+    def __iter__(self):
+        try:
+            f = self.path.open()
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping corrupt line in %s', self.path)
+
+    def summarize(self, image=None, since=None):
+        # Returns {(image, qemu, event): {phase: {count, p50, ..., max}}}.
+        samples = {}
+        for record in self:
+            if image and record.get('image') != image:
+                continue
+            if since and record['time'] < since:
+                continue
+            key = (record.get('image'), record.get('qemu'), record['event'])
+            phases = samples.setdefault(key, {})
+            for phase, seconds in record['phases'].items():
+                phases.setdefault(phase, []).append(seconds)
+            if len(record['phases']) > 1:
+                phases.setdefault('total', []).append(
+                    sum(record['phases'].values())
+                )
+
+        summary = {}
+        for key, phases in samples.items():
+            summary[key] = {}
+            for phase, values in phases.items():
+                values.sort()
+                summary[key][phase] = dict(
+                    count=len(values),
+                    **{f'p{p}': percentile(values, p) for p in PERCENTILES},
+                    max=values[-1],
+                )
+        return summary
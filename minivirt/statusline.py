@@ -11,6 +11,16 @@ class StatusLine:
     def __init__(self, vm):
         self.vm = vm
         self.prev = None
+        self.display = False
+        self.please_stop = False
+        # Called with each line from the serial console.
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
 
     def serial_lines(self):
         utils.waitfor(self.vm.serial_path.exists)
@@ -25,7 +35,12 @@ class StatusLine:
 
     def run(self):
         for line in self.serial_lines():
-            if self.please_stop:
+            for listener in list(self.listeners):
+                listener(line)
+
+            if self.please_stop or not self.display:
+                if self.listeners:
+                    continue
                 return
 
             line = line[:shutil.get_terminal_size().columns]
@@ -36,9 +51,10 @@ class StatusLine:
             print(line, end='\r')  # noqa: T201
             self.prev = line
 
-    def start(self):
+    def start(self, display=True):
         self.please_stop = False
-        if sys.stdout.isatty():
+        self.display = display and sys.stdout.isatty()
+        if self.display or self.listeners:
             threading.Thread(target=self.run, daemon=True).start()
 
     def stop(self):
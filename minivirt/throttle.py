@@ -0,0 +1,196 @@
+import fcntl
+import logging
+from contextlib import contextmanager
+
+from .configs import Config
+from .diskusage import parse_size
+from .exceptions import QMPError, WaitTimeout
+
+logger = logging.getLogger(__name__)
+
+# Limits use the names of `block_set_io_throttle` arguments, mapped here to
+# the equivalent `-drive` options. 0 means unlimited.
+DRIVE_OPTIONS = {
+    f'{kind}{op}{suffix}': f'throttling.{kind}-{name}{option_suffix}'
+    for kind in ['bps', 'iops']
+    for op, name in [('', 'total'), ('_rd', 'read'), ('_wr', 'write')]
+    for suffix, option_suffix in [
+        ('', ''), ('_max', '-max'), ('_max_length', '-max-length'),
+    ]
+}
+DRIVE_OPTIONS['iops_size'] = 'throttling.iops-size'
+
+# block_set_io_throttle requires these.
+REQUIRED = ['bps', 'bps_rd', 'bps_wr', 'iops', 'iops_rd', 'iops_wr']
+
+# Not part of the budget, so never divided.
+UNDIVIDED = ['iops_size']
+
+
+def parse_limits(spec):
+    # "iops=500,bps=50M,iops_max=2000" -> {'iops': 500, ...}
+    limits = {}
+    for item in filter(None, spec.split(',')):
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key not in DRIVE_OPTIONS:
+            raise ValueError(f'Unknown I/O limit {key!r}')
+        if key.startswith('bps') and not key.endswith('_length'):
+            limits[key] = parse_size(value)
+        else:
+            limits[key] = int(value)
+    return limits
+
+
+def combine(limits, other):
+    # The stricter of both sets of limits.
+    rv = dict(limits)
+    for key, value in other.items():
+        if not value:
+            continue
+        if key.endswith('_length'):
+            rv.setdefault(key, value)
+        elif rv.get(key):
+            rv[key] = min(rv[key], value)
+        else:
+            rv[key] = value
+
+    for kind in ['bps', 'iops']:
+        split_total(rv, kind)
+
+    # QEMU refuses bursts below the sustained rate.
+    for key, value in rv.items():
+        base = key[:-len('_max')]
+        if key.endswith('_max') and value and value < rv.get(base, 0):
+            rv[key] = rv[base]
+    return rv
+
+
+def split_total(limits, kind):
+    # QEMU refuses a total limit next to read/write limits on the same
+    # drive. Turn the total into read and write limits that add up to it.
+    sides = [f'{kind}_rd', f'{kind}_wr']
+    if not (
+        any(limits.get(kind + suffix) for suffix in ['', '_max'])
+        and any(key.startswith(tuple(sides)) for key in limits)
+    ):
+        return
+
+    for suffix in ['', '_max']:
+        total = limits.pop(kind + suffix, 0)
+        if not total:
+            continue
+        rd, wr = (min(limits.get(side + suffix) or 0, total) for side in sides)
+        if rd and wr and rd + wr > total:
+            rd = max(total * rd // (rd + wr), 1)
+            wr = max(total - rd, 1)
+        elif rd and not wr:
+            wr = max(total - rd, 1)
+        elif wr and not rd:
+            rd = max(total - wr, 1)
+        elif not (rd or wr):
+            rd = wr = max(total // 2, 1)
+        limits[sides[0] + suffix], limits[sides[1] + suffix] = rd, wr
+
+    length = limits.pop(f'{kind}_max_length', 0)
+    for side in sides:
+        if length:
+            limits.setdefault(f'{side}_max_length', length)
+        # A burst needs a sustained rate.
+        if limits.get(f'{side}_max') and not limits.get(side):
+            del limits[f'{side}_max']
+
+
+def divide(limits, count):
+    return {
+        key: (
+            value if key.endswith('_length') or key in UNDIVIDED
+            else max(value // count, 1)
+        )
+        for key, value in limits.items()
+        if value
+    }
+
+
+def drive_options(limits, group=None):
+    options = {
+        DRIVE_OPTIONS[key]: value for key, value in limits.items() if value
+    }
+    if options and group:
+        options['throttling.group'] = group
+    return options
+
+
+def qmp_arguments(limits, group=None):
+    arguments = dict.fromkeys(REQUIRED, 0)
+    arguments.update(limits)
+    if group:
+        arguments['group'] = group
+    return arguments
+
+
+class ThrottleGroups:
+    # A group's budget is shared by all of its running VMs, which each run
+    # in their own QEMU process. The budget is split evenly, and split
+    # again, live, whenever a VM of the group starts or stops.
+
+    def __init__(self, db):
+        self.db = db
+        self.path = db.path / 'throttle.json'
+        self.config = Config(self.path)
+
+    def groups(self):
+        return self.config.get('groups', {})
+
+    def set_group(self, name, limits):
+        with self.lock():
+            if limits:
+                self.config.setdefault('groups', {})[name] = limits
+            else:
+                self.config.get('groups', {}).pop(name, None)
+            self.config.save()
+        self.rebalance(name)
+
+    @contextmanager
+    def lock(self):
+        self.db.path.mkdir(parents=True, exist_ok=True)
+        with (self.db.path / 'throttle.lock').open('a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Pick up changes made by other processes.
+            self.config.__dict__.pop('content', None)
+            yield
+
+    def members(self, name):
+        for vm in self.db.iter_vms():
+            if vm.config.get('throttle_group') == name and vm.is_running:
+                yield vm
+
+    def share(self, vm):
+        # The budget of `vm`, counting it as running.
+        name = vm.config.get('throttle_group')
+        limits = self.groups().get(name)
+        if not limits:
+            return {}
+        with self.lock():
+            members = {member.name for member in self.members(name)}
+        members.add(vm.name)
+        return divide(limits, len(members))
+
+    def rebalance(self, name, starting=None):
+        # `starting` counts as a member, though QEMU may not be up yet; it
+        # got its share on the command line, and rebalances again once QMP
+        # is up, in case another member started in the meantime.
+        if not name:
+            return
+        with self.lock():
+            members = [
+                vm for vm in self.members(name)
+                if starting is None or vm.name != starting.name
+            ]
+            count = len(members) + (starting is not None)
+            share = divide(self.groups().get(name, {}), max(count, 1))
+            for vm in members:
+                try:
+                    vm.apply_io_throttle(share)
+                except (OSError, QMPError, WaitTimeout) as e:
+                    logger.warning('Could not throttle %s: %s', vm, e)
@@ -8,7 +8,10 @@ from .exceptions import WaitTimeout
 logger = logging.getLogger(__name__)
 
 
-def waitfor(condition, help=None, timeout=10, poll_interval=0.1):
+def waitfor(
+    condition, help=None, timeout=10, poll_interval=0.1, max_interval=None
+):
+    # With `max_interval`, the interval doubles after each attempt.
     if not help:
         help = (condition.__doc__ or repr(condition)).strip()
     expires = time.monotonic() + timeout
@@ -19,30 +22,39 @@ def waitfor(condition, help=None, timeout=10, poll_interval=0.1):
             logger.debug('Polling for %s successful: %r.', help, rv)
             return rv
         time.sleep(poll_interval)
+        if max_interval:
+            poll_interval = min(poll_interval * 2, max_interval)
 
     raise WaitTimeout('Timeout expired')
 
 
+def probe_ssh(port):
+    logger.debug('SSH: trying to connect to port %d ...', port)
+    try:
+        sock = socket.create_connection(('localhost', port))
+    except OSError as e:
+        logger.debug('SSH: got an OSError: %s', e)
+        return False
+    with sock:
+        sock.setblocking(0)
+        logger.debug('SSH: connected, reading 3 bytes ...')
+        # Returns early if QEMU closes the connection because nothing
+        # listens in the guest.
+        ready = select.select([sock], [], [], 1)
+        logger.debug('SSH: ready: %r', ready)
+        if not ready[0]:
+            logger.debug('SSH: no data ready')
+            return False
+        buffer = sock.recv(3)
+        logger.debug('SSH: received %s', buffer)
+        if buffer == b'SSH':
+            logger.debug('SSH: success!')
+            return True
+    return False
+
+
 def wait_for_ssh(port, timeout=10):
     def ssh_tcp():
-        logger.debug('SSH: trying to connect to port %d ...', port)
-        try:
-            sock = socket.create_connection(('localhost', port))
-        except OSError as e:
-            logger.debug('SSH: got an OSError: %s', e)
-            return False
-        else:
-            sock.setblocking(0)
-            logger.debug('SSH: connected, reading 3 bytes ...')
-            ready = select.select([sock], [], [], 0.1)
-            logger.debug('SSH: ready: %r', ready)
-            if not ready[0]:
-                logger.debug('SSH: no data ready')
-                return False
-            buffer = sock.recv(3)
-            logger.debug('SSH: received %s', buffer)
-            if buffer == b'SSH':
-                logger.debug('SSH: success!')
-                return True
-
-    waitfor(ssh_tcp, timeout=timeout)
+        return probe_ssh(port)
+
+    waitfor(ssh_tcp, timeout=timeout, poll_interval=0.01, max_interval=1)
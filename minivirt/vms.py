@@ -1,25 +1,91 @@
+import io
 import json
 import logging
 import os
 import random
+import re
+import secrets
+import shlex
 import shutil
+import signal
 import subprocess
+import sys
 import tempfile
+import time
 from contextlib import contextmanager
 from functools import cached_property
 from pathlib import Path
 from textwrap import dedent
 
-from . import qemu, utils
+from . import qcow2, qemu, throttle, utils
+from .agent import GuestAgent
+from .clone import clone_file
 from .configs import Config
-from .exceptions import VmExists, VmIsRunning
+from .exceptions import VmExists, VmIsRunning, WaitTimeout
+from .qmp import QMP, borrow, close_session, session
+from .readiness import Readiness
 from .statusline import StatusLine
 
 VAGRANT_PRIVATE_KEY_PATH = Path(__file__).parent / 'vagrant-private-key'
+SHM_PATH = Path('/dev/shm')
+if not SHM_PATH.is_dir():
+    SHM_PATH = Path(tempfile.gettempdir())
 
 logger = logging.getLogger(__name__)
 
 RESOURCE_TYPES = {}
+PROBE_TIMEOUT = 1
+SSH_CONTROL_PERSIST = 600
+# Settings that VMs inherit from their image, and images from the VM they
+# are committed from.
+IMAGE_FEATURES = ['agent', 'ready_marker']
+# Per-VM settings; when missing, defaults come from probing the host.
+OPTIONS = [
+    'cpus', 'threads', 'iothreads', 'cache', 'aio', 'discard', 'throttle',
+    'throttle_group',
+]
+MAX_L2_CACHE_SIZE = 32 * 2**20
+# Bumped when the devices change, as saved state only restores on the same
+# hardware.
+STATE_VERSION = 2
+
+
+def memory_size(config):
+    memory = str(config['memory'])
+    return f'{memory}M' if memory.isdigit() else memory
+
+
+def process_start_time(pid):
+    # The start time tells a process apart from a later one with the same
+    # pid. Returns None if the process is gone.
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except FileNotFoundError:
+        if Path('/proc/self/stat').exists():
+            return None
+        # No procfs (macOS), settle for checking that the pid exists.
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        return 0
+
+    if fields[0] in ['Z', 'X']:
+        return None
+    return int(fields[19])
+
+
+def read_smaps_rollup(pid):
+    usage = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            m = re.match(r'(\w+):\s+(\d+) kB', line)
+            if m:
+                usage[m.group(1)] = int(m.group(2)) * 1024
+    return usage
 
 
 def resource_type(name):
@@ -30,18 +96,47 @@ def resource_type(name):
     return decorator
 
 
+def l2_cache_size(path):
+    # Enough L2 cache to map the whole disk, so that random I/O doesn't
+    # thrash it.
+    header = qcow2.read_header(path)
+    if header is None:
+        return None
+    clusters = -(-header.size // header.cluster_size)
+    return min(clusters * header.l2_entry_size, MAX_L2_CACHE_SIZE)
+
+
 @resource_type('disk')
 class Disk:
-    def __init__(self, path):
+    def __init__(self, path, throttle=None):
         self.path = path
-        self.qemu_args = ['-drive', f'if=virtio,file={self.path}']
+        # I/O limits of this disk alone; otherwise it shares the VM's.
+        self.throttle = throttle
+
+    def get_qemu_args(self, id, options, iothread=False):
+        filename = str(self.path).replace(',', ',,')
+        drive = f'if=none,id={id},file={filename}'
+        for key, value in options.items():
+            drive += f',{key}={value}'
+        l2_size = l2_cache_size(self.path)
+        if l2_size:
+            drive += f',l2-cache-size={l2_size}'
+
+        args = ['-drive', drive]
+        device = f'virtio-blk-pci,drive={id}'
+        if iothread:
+            args += ['-object', f'iothread,id={id}-io']
+            device += f',iothread={id}-io'
+        return args + ['-device', device]
 
 
 @resource_type('cdrom')
 class CDROM:
     def __init__(self, path):
         self.path = path
-        self.qemu_args = ['-cdrom', self.path]
+
+    def get_qemu_args(self, id, options, iothread=False):
+        return ['-cdrom', self.path]
 
 
 class PortForward:
@@ -55,7 +150,13 @@ class PortForward:
 
 class VM:
     @classmethod
-    def create(cls, db, name, memory, image=None, disk=None, ports=()):
+    def create(
+        cls, db, name, memory, image=None, disk=None, ports=(), **options
+    ):
+        unknown = set(options) - set(OPTIONS)
+        if unknown:
+            raise TypeError(f'Unknown VM options: {", ".join(unknown)}')
+        t0 = time.monotonic()
         vm = cls(db, name)
         if vm.path.exists():
             raise VmExists(name)
@@ -74,7 +175,19 @@ class VM:
             image=image and image.name,
             memory=memory,
         )
+        for key in IMAGE_FEATURES:
+            if image and image.config.get(key):
+                vm.config[key] = image.config[key]
+        if image and image.config.get('state'):
+            # Match the saved state, so the VM can resume from it.
+            vm.config['cpus'] = image.config.get('cpus', 1)
+        vm.config.update(
+            (key, value) for key, value in options.items()
+            if value is not None
+        )
         vm.config.save()
+        db.index.add_vm(name, image and image.name)
+        vm.timings['create'] = time.monotonic() - t0
 
         return vm
 
@@ -84,9 +197,12 @@ class VM:
         self.path = db.vm_path(name)
         self.config = Config(self.path / 'config.json')
         self.qmp_path = self.path / 'qmp'
+        self.agent_path = self.path / 'agent'
         self.serial_path = self.path / 'serial'
         self.disk_path = self.path / 'disk.qcow2'
         self.ssh_config_path = self.path / 'ssh-config'
+        # Seconds spent in each phase of the last boot.
+        self.timings = {}
 
     def __repr__(self):
         return f'<VM {self.name!r}>'
@@ -151,7 +267,10 @@ class VM:
 
         for resource in self.config.get('resources', []):
             if resource['type'] == 'disk':
-                yield Disk(self.path / resource['filename'])
+                yield Disk(
+                    self.path / resource['filename'],
+                    throttle=resource.get('throttle'),
+                )
 
             elif resource['type'] == 'cdrom':
                 yield CDROM(self.path / resource['filename'])
@@ -159,29 +278,206 @@ class VM:
             else:
                 raise RuntimeError('Unknown resource type')
 
+    def get_usage(self):
+        return self.db.disk_usage.usage(self.path)
+
     @property
     def ports(self):
         for port_forward in self.config.get('ports', []):
             yield PortForward(**port_forward)
 
     def connect_qmp(self):
-        with tempfile.TemporaryDirectory() as tmp:
-            sock_path = Path(tmp) / 'sock'
-            sock_path.symlink_to(self.qmp_path)
-            return qemu.QMP(sock_path)
+        return session(self.qmp_path)
+
+    def disconnect_qmp(self):
+        # Let other processes talk to QEMU.
+        close_session(self.qmp_path)
 
     @property
     def is_running(self):
-        if self.qmp_path.exists():
-            try:
-                self.connect_qmp()
-            except ConnectionRefusedError:
-                logger.warning('QEMU is gone for %s', self)
-            else:
-                return True
+        if not self.qmp_path.exists():
+            return False
+
+        run_info = self.run_info
+        if 'pid' in run_info:
+            start_time = process_start_time(run_info['pid'])
+            return start_time is not None and (
+                start_time == run_info['start_time']
+            )
+
+        # Started by an older version, without a pid.
+        try:
+            self.connect_qmp()
+        except ConnectionRefusedError:
+            logger.warning('QEMU is gone for %s', self)
+        except WaitTimeout:
+            # Another process is connected to QMP.
+            return True
+        else:
+            return True
 
         return False
 
+    def probe(self, timeout=PROBE_TIMEOUT):
+        # Ask QEMU itself, to tell a hung process from a healthy one.
+        if not self.is_running:
+            return 'down'
+        try:
+            client = QMP(self.qmp_path, timeout=timeout)
+        except OSError:
+            return 'down'
+        except WaitTimeout:
+            return 'unresponsive'
+        try:
+            return client.execute('query-status', timeout=timeout)['status']
+        except WaitTimeout:
+            return 'unresponsive'
+        finally:
+            client.close()
+
+    @property
+    def state_path(self):
+        # A VM that has never booted can resume from its image's saved
+        # state, as long as the hardware is the same.
+        if self.config.get('booted') or not self.image:
+            return None
+        state = self.image.config.get('state')
+        if not state or self.config.get('resources'):
+            return None
+        if str(self.image.config.get('memory')) != str(self.config['memory']):
+            return None
+        if self.image.config.get('state_version', 1) != STATE_VERSION:
+            return None
+        if self.image.config.get('cpus', 1) != self.cpus:
+            return None
+        return self.image.path / state
+
+    def iter_drives(self):
+        for n, resource in enumerate(self.resources):
+            yield f'drive{n}', resource
+
+    def get_io_throttle(self, disk, share):
+        # Disks without limits of their own share the VM's, in a throttle
+        # group. The VM's share of its throttle group's budget caps both.
+        if disk.throttle:
+            limits, group = disk.throttle, None
+        else:
+            limits, group = self.config.get('throttle', {}), 'vm'
+        limits = throttle.combine(limits, share)
+        return limits, group if limits else None
+
+    def apply_io_throttle(self, share=None):
+        if share is None:
+            share = self.db.throttle.share(self)
+        with borrow(self.qmp_path, timeout=PROBE_TIMEOUT) as qmp:
+            for drive_id, resource in self.iter_drives():
+                if not isinstance(resource, Disk):
+                    continue
+                limits, group = self.get_io_throttle(resource, share)
+                qmp.execute(
+                    'block_set_io_throttle',
+                    device=drive_id,
+                    **throttle.qmp_arguments(limits, group),
+                )
+
+    def set_io_throttle(self, limits, disk=None):
+        if disk is None:
+            self.config['throttle'] = limits
+        else:
+            for resource in self.config.get('resources', []):
+                if resource['type'] == 'disk' and resource['filename'] == disk:
+                    resource['throttle'] = limits
+                    break
+            else:
+                raise ValueError(f'{self} has no disk {disk!r}')
+        self.config.save()
+        if self.is_running:
+            self.apply_io_throttle()
+
+    @property
+    def cpus(self):
+        return self.config.get('cpus') or self.db.host.default_cpus()
+
+    def get_smp_arg(self):
+        threads = self.config.get('threads', 1)
+        if self.cpus % threads:
+            raise ValueError(
+                f'{self.cpus} vCPUs can not be split in cores of {threads}'
+                ' threads'
+            )
+        return (
+            f'cpus={self.cpus},sockets=1,cores={self.cpus // threads},'
+            f'threads={threads}'
+        )
+
+    def get_drive_options(self, snapshot=False):
+        host = self.db.host.probe(self.path)
+        if snapshot:
+            # Writes are thrown away at exit, so don't bother flushing them.
+            cache = 'unsafe'
+        else:
+            cache = self.config.get('cache')
+            if cache is None:
+                cache = 'none' if host['direct_io'] else 'writeback'
+        aio = self.config.get('aio') or host['aio']
+        if aio == 'native' and cache not in ['none', 'directsync']:
+            # Linux native AIO only works with O_DIRECT.
+            aio = 'threads'
+        return {
+            'cache': cache,
+            'aio': aio,
+            'discard': self.config.get('discard', 'unmap'),
+        }
+
+    @property
+    def run_info(self):
+        try:
+            with (self.path / 'run.json').open() as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_run_info(self, **kwargs):
+        run_info = dict(self.run_info, **kwargs)
+        with (self.path / 'run.json').open('w') as f:
+            json.dump(run_info, f)
+
+    def record_timings(self, event, phases):
+        # The current run's timings go in run.json, and all of them in the
+        # database's history, for `miv stats`.
+        self.timings.update(phases)
+        if self.path.exists():
+            self.save_run_info(timings=self.timings)
+        self.db.history.append(
+            event,
+            phases,
+            vm=self.name,
+            image=self.config.get('image'),
+            qemu=qemu.get_version(),
+        )
+
+    def save_state(self, path):
+        logger.info('Saving the state of %s ...', self)
+        config = {
+            'state': 'memory.state',
+            'state_version': STATE_VERSION,
+            'memory': self.config['memory'],
+            'cpus': self.cpus,
+        }
+        ram_path = self.run_info.get('ram_path')
+        qmp = self.connect_qmp()
+        if ram_path:
+            # Guest RAM is in a file; save it as it is, and leave it out of
+            # the migration stream.
+            qmp.set_migrate_capability('x-ignore-shared')
+        state_path = shlex.quote(str(path / config['state']))
+        qmp.migrate(f'exec:cat > {state_path}')
+        if ram_path:
+            clone_file(ram_path, path / 'memory.ram')
+            config['ram'] = 'memory.ram'
+        self.kill(wait=True)
+        return config
+
     def _get_netdev_arg(self, ssh_port):
         hostfwd = ','.join(
             f'hostfwd=tcp:127.0.0.1:{pf.host_port}-:{pf.guest_port}'
@@ -197,21 +493,43 @@ class VM:
         wait_for_ssh=None,
         statusline=True,
         usb=(),
+        shared_memory=False,
     ):
         if self.is_running:
             raise VmIsRunning(f'{self} is already running')
 
         logger.info('Starting %s ...', self.name)
+        t0 = time.monotonic()
+        phases = {}
+        if 'create' in self.timings:
+            phases['create'] = self.timings['create']
+        self.timings = {}
 
         ssh_port = random.randrange(20000, 32000)
+        run_info = {'ssh_port': ssh_port}
+        state_path = self.state_path
+        ram_path = None
+        if state_path and self.image.config.get('ram'):
+            ram_path = self.image.path / self.image.config['ram']
+            shared = False
+        elif shared_memory:
+            ram_path = SHM_PATH / f'miv-{self.name}-{ssh_port}.ram'
+            run_info['ram_path'] = str(ram_path)
+            shared = True
 
         with (self.path / 'run.json').open('w') as f:
-            json.dump({'ssh_port': ssh_port}, f)
+            json.dump(run_info, f)
 
         ssh_private_key_path = self.path / 'ssh-private-key'
         shutil.copy(VAGRANT_PRIVATE_KEY_PATH, ssh_private_key_path)
         ssh_private_key_path.chmod(0o600)
 
+        # One master connection per run; the path must be short, since it's
+        # a unix socket.
+        control_path = (
+            Path(tempfile.gettempdir()) / f'miv-ssh-{secrets.token_hex(8)}'
+        )
+
         with self.ssh_config_path.open('w') as f:
             f.write(
                 dedent(
@@ -224,6 +542,9 @@ class VM:
                             User root
                             IdentityFile {ssh_private_key_path}
                             LogLevel=quiet
+                            ControlMaster auto
+                            ControlPath {control_path}
+                            ControlPersist {SSH_CONTROL_PERSIST}
                     '''
                 )
             )
@@ -235,13 +556,25 @@ class VM:
         qemu_cmd = [
             *qemu.command_prefix,
             '-qmp', f'unix:{qmp_path},server,nowait',
+            '-pidfile', 'qemu.pid',
             '-m', str(self.config['memory']),
+            '-smp', self.get_smp_arg(),
             '-boot', 'menu=on,splash-time=0',
             '-netdev', self._get_netdev_arg(ssh_port),
             '-device', 'virtio-net-pci,netdev=user,romfile=',
             '-device', 'qemu-xhci',
         ]
 
+        if self.config.get('agent'):
+            agent_path = self.agent_path.relative_to(self.path)
+            qemu_cmd += [
+                '-chardev', f'socket,id=agent,path={agent_path},server=on,'
+                'wait=off',
+                '-device', 'virtio-serial',
+                '-device',
+                'virtserialport,chardev=agent,name=org.qemu.guest_agent.0',
+            ]
+
         if display:
             qemu_cmd += qemu.get_display_args()
 
@@ -250,14 +583,50 @@ class VM:
                 '-nographic',
             ]
 
-        for resource in self.resources:
-            qemu_cmd += resource.qemu_args
+        drive_options = self.get_drive_options(snapshot)
+        iothreads = self.config.get('iothreads', True)
+        share = self.db.throttle.share(self)
+        for drive_id, resource in self.iter_drives():
+            options = drive_options
+            if isinstance(resource, Disk):
+                limits, group = self.get_io_throttle(resource, share)
+                options = dict(
+                    options, **throttle.drive_options(limits, group)
+                )
+            qemu_cmd += resource.get_qemu_args(
+                drive_id, options, iothread=iothreads
+            )
 
         if snapshot:
             qemu_cmd += [
                 '-snapshot',
             ]
 
+        if ram_path:
+            # With share=off, clones map the saved RAM copy-on-write, so
+            # pages they don't modify stay shared in the host page cache.
+            qemu_cmd += [
+                '-object',
+                f'memory-backend-file,id=ram,size={memory_size(self.config)},'
+                f'mem-path={ram_path},share={"on" if shared else "off"},'
+                'mem-merge=on',
+                '-machine', 'memory-backend=ram',
+            ]
+
+        incoming_uri = None
+        if state_path:
+            logger.info('Resuming %s from saved state', self.name)
+            state_path = shlex.quote(str(self.relative_path(state_path)))
+            incoming_uri = f'exec:cat {state_path}'
+            if ram_path:
+                # Capabilities must be set before the migration starts.
+                qemu_cmd += ['-incoming', 'defer']
+            else:
+                qemu_cmd += ['-incoming', incoming_uri]
+
+        self.config['booted'] = True
+        self.config.save()
+
         for usb_item in usb:
             vendorid, productid = usb_item.split(':')
             qemu_cmd += [
@@ -271,14 +640,40 @@ class VM:
                 '-serial', f'unix:{serial_path},server=on,wait=off',
             ]
 
-            if os.fork():
-                sl = StatusLine(self)
-                if statusline:
-                    sl.start()
+            sl = StatusLine(self)
+            phases['prepare'] = time.monotonic() - t0
+            readiness = None
+            if wait_for_ssh:
+                readiness = Readiness(self, sl, resumed=bool(incoming_uri))
 
-                if wait_for_ssh:
-                    utils.wait_for_ssh(ssh_port, wait_for_ssh)
+            pid = os.fork()
+            if pid:
+                self.save_run_info(
+                    pid=pid, start_time=process_start_time(pid)
+                )
+                self.db.throttle.rebalance(
+                    self.config.get('throttle_group'), starting=self
+                )
+                sl.start(display=statusline)
+
+                if ram_path and incoming_uri:
+                    self.migrate_incoming(incoming_uri)
+                    self.disconnect_qmp()
+                    if readiness:
+                        readiness.mark('restore')
+
+                # Members that started since we took our share.
+                self.db.throttle.rebalance(self.config.get('throttle_group'))
+
+                if readiness:
+                    with readiness:
+                        readiness.wait(ssh_port, wait_for_ssh)
+                    phases.update(readiness.timings)
+                    self.record_timings('boot', phases)
                     sl.stop()
+                else:
+                    self.timings.update(phases)
+                    self.save_run_info(timings=self.timings)
 
                 return
 
@@ -290,22 +685,79 @@ class VM:
                 '-serial', 'mon:stdio',
             ]
 
+            pid = os.getpid()
+            self.save_run_info(pid=pid, start_time=process_start_time(pid))
+            self.db.throttle.rebalance(
+                self.config.get('throttle_group'), starting=self
+            )
+
+            if not os.fork():
+                if ram_path and incoming_uri:
+                    self.migrate_incoming(incoming_uri)
+                # Members that started since we took our share.
+                self.db.throttle.rebalance(self.config.get('throttle_group'))
+                os._exit(0)
+
             os.chdir(self.path)
             os.execvp(qemu_cmd[0], qemu_cmd)
 
+    def migrate_incoming(self, uri):
+        qmp = self.connect_qmp()
+        qmp.set_migrate_capability('x-ignore-shared')
+        qmp.execute('migrate-incoming', uri=uri)
+
+    @property
+    def pid(self):
+        try:
+            return int((self.path / 'qemu.pid').read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get_memory_usage(self):
+        # Shared pages are the ones that clones map from the same saved RAM
+        # file, or that KSM has merged.
+        usage = read_smaps_rollup(self.pid)
+        return {
+            'rss': usage.get('Rss', 0),
+            'pss': usage.get('Pss', 0),
+            'shared': (
+                usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0)
+            ),
+            'private': (
+                usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0)
+            ),
+        }
+
     def wait(self, timeout=10):
         logger.info('Waiting for %s to exit ...', self)
-        utils.waitfor(lambda: not self.qmp_path.exists(), timeout=timeout)
+        try:
+            qmp = self.connect_qmp() if self.qmp_path.exists() else None
+        except (OSError, WaitTimeout):
+            qmp = None
+
+        if qmp is not None:
+            # QEMU closes the connection when it exits.
+            qmp.wait_closed(timeout)
+        else:
+            utils.waitfor(lambda: not self.qmp_path.exists(), timeout=timeout)
         logger.info('%s has stopped.', self)
 
     def wait_for_ssh(self, timeout=30):
         with (self.path / 'run.json').open() as f:
             ssh_port = json.load(f)['ssh_port']
+        t0 = time.monotonic()
         utils.wait_for_ssh(ssh_port, timeout)
+        self.record_timings('ssh', {'ssh': time.monotonic() - t0})
 
     def stop(self, wait=10):
         StatusLine(self).start()
-        qmp = self.connect_qmp()
+        try:
+            qmp = self.connect_qmp()
+        except WaitTimeout:
+            # Another process holds the monitor.
+            logger.warning('QMP is not answering, killing %s', self)
+            self.kill(wait=True)
+            return
         qmp.poweroff()
         try:
             self.wait(wait)
@@ -315,22 +767,45 @@ class VM:
     def kill(self, wait=False):
         if self.is_running:
             logger.info('%s is running; killing via QMP ...', self)
-            qmp = self.connect_qmp()
-            qmp.quit()
+            try:
+                qmp = self.connect_qmp()
+                qmp.quit()
+            except WaitTimeout:
+                pid = self.run_info.get('pid')
+                if not pid:
+                    raise
+                logger.warning('QMP is not answering, sending SIGKILL')
+                os.kill(pid, signal.SIGKILL)
             if wait:
                 self.wait()
 
         self.cleanup()
 
     def cleanup(self):
+        self.stop_ssh_master()
+        ram_path = self.run_info.get('ram_path')
+        if ram_path:
+            Path(ram_path).unlink(missing_ok=True)
+        (self.path / 'qemu.pid').unlink(missing_ok=True)
         self.qmp_path.unlink(missing_ok=True)
+        # The others in the throttle group get a bigger share.
+        self.db.throttle.rebalance(self.config.get('throttle_group'))
+        self.agent_path.unlink(missing_ok=True)
         self.serial_path.unlink(missing_ok=True)
         self.ssh_config_path.unlink(missing_ok=True)
 
     def destroy(self):
+        t0 = time.monotonic()
         self.kill(wait=True)
+        t1 = time.monotonic()
         if self.path.exists():
+            # Load the config before its file goes away.
+            self.config.get('image')
             shutil.rmtree(self.path)
+            self.record_timings(
+                'destroy', {'kill': t1 - t0, 'remove': time.monotonic() - t1}
+            )
+        self.db.index.remove_vm(self.name)
 
     def console(self):
         os.execvp(
@@ -347,28 +822,114 @@ class VM:
         hostname = f'{self.name}.miv'
         return fn(['ssh', '-F', self.ssh_config_path, hostname, *args])
 
-    def commit(self):
+    def connect_agent(self):
+        if not (self.config.get('agent') and self.agent_path.exists()):
+            return None
+        try:
+            return GuestAgent(self.agent_path)
+        except (OSError, WaitTimeout) as e:
+            logger.debug('Guest agent is not available for %s: %s', self, e)
+            return None
+
+    def execute(self, *args, capture=False):
+        # Like `ssh`, but through the guest agent if the image has one, which
+        # saves spawning ssh and a key exchange for each command.
+        agent = self.connect_agent()
+        if agent is None:
+            return self.ssh(*args, capture=capture)
+
+        command = ' '.join(args)
+        stdout = io.BytesIO() if capture else sys.stdout.buffer
+        with agent:
+            returncode = agent.exec(command, stdout, sys.stderr.buffer)
+        output = stdout.getvalue() if capture else None
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output)
+        return output
+
+    def ssh_batch(self, commands, capture=False):
+        # The first command opens the master connection, the rest reuse it.
+        # Stops at the first command that fails.
+        return [self.ssh(command, capture=capture) for command in commands]
+
+    def stop_ssh_master(self):
+        if not self.ssh_config_path.exists():
+            return
+        subprocess.run(
+            [
+                'ssh', '-F', self.ssh_config_path, '-O', 'exit',
+                f'{self.name}.miv',
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    @property
+    def is_layered(self):
+        if not (self.image and self.image.config.get('disk')):
+            return False
+        backing_file = qcow2.read_header(self.disk_path).backing_file
+        if not backing_file:
+            return False
+        backing_path = (self.path / backing_file).resolve()
+        return backing_path == (self.image.path / 'disk.qcow2').resolve()
+
+    def commit(self, state=False):
         logger.info('Comitting image for %s', self)
         with self.db.create_image() as creator:
             config = {
                 'disk': True,
+                'checksum': 'merkle',
             }
+            for key in IMAGE_FEATURES:
+                if self.config.get(key):
+                    config[key] = self.config[key]
+            disk_path = creator.path / self.disk_path.name
+
+            if state:
+                # Saving the state stops the VM, so the disk matches it.
+                config.update(self.save_state(creator.path))
+
+            if self.is_layered:
+                logger.info('Storing changes on top of %s', self.image)
+                config['parent'] = self.image.name
+                clone_file(self.disk_path, disk_path)
+                subprocess.check_call([
+                    'qemu-img', 'rebase', '-u',
+                    '-b', f'../{self.image.name}/disk.qcow2',
+                    '-F', 'qcow2',
+                    disk_path,
+                ])
+
+            else:
+                # This also compacts standalone disks, leaving out clusters
+                # that are unused or zeroed.
+                subprocess.check_call([
+                    'qemu-img', 'convert', '-O', 'qcow2',
+                    self.disk_path, disk_path,
+                ])
+
             with (creator.path / 'config.json').open('w') as f:
                 json.dump(config, f, indent=2)
-            subprocess.check_call([
-                'qemu-img', 'convert', '-O', 'qcow2',
-                self.disk_path, creator.path / self.disk_path.name
-            ])
 
         return creator.image
 
     @contextmanager
     def run(self, **kwargs):
+        t0 = None
         try:
             self.start(daemon=True, **kwargs)
+            t0 = time.monotonic()
             yield
         finally:
+            t1 = time.monotonic()
             self.kill(wait=True)
+            if t0 is not None:
+                self.record_timings('run', {
+                    'used': t1 - t0,
+                    'kill': time.monotonic() - t1,
+                })
 
     def fsck(self):
         if self.config.get('image'):
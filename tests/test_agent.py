@@ -0,0 +1,82 @@
+import base64
+import io
+import json
+import socket
+import subprocess
+import threading
+
+from minivirt.agent import GuestAgent
+
+
+class FakeAgent:
+    # Runs the commands on the host, like qemu-guest-agent would in a guest.
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(str(path))
+        self.sock.listen(1)
+        self.files = {}
+        self.processes = {}
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        conn, _ = self.sock.accept()
+        self.conn = conn
+        writer = conn.makefile('wb')
+
+        def send(value, prefix=b''):
+            writer.write(prefix + json.dumps({'return': value}).encode())
+            writer.write(b'\n')
+            writer.flush()
+
+        # A reply that a previous client didn't wait for.
+        send({'stale': True})
+
+        for line in conn.makefile('rb'):
+            msg = json.loads(line)
+            args = msg.get('arguments', {})
+            command = msg['execute']
+            if command == 'guest-sync-delimited':
+                send(args['id'], prefix=b'\xff')
+            elif command == 'guest-file-open':
+                handle = len(self.files) + 1
+                self.files[handle] = open(args['path'], args['mode'] + 'b')
+                send(handle)
+            elif command == 'guest-file-seek':
+                f = self.files[args['handle']]
+                send({'position': f.seek(args['offset'], 1), 'eof': False})
+            elif command == 'guest-file-read':
+                data = self.files[args['handle']].read(args['count'])
+                send({
+                    'count': len(data),
+                    'buf-b64': base64.b64encode(data).decode(),
+                    'eof': len(data) < args['count'],
+                })
+            elif command == 'guest-file-close':
+                self.files.pop(args['handle']).close()
+                send({})
+            elif command == 'guest-exec':
+                proc = subprocess.Popen([args['path'], *args['arg']])
+                self.processes[proc.pid] = proc
+                send({'pid': proc.pid})
+            elif command == 'guest-exec-status':
+                returncode = self.processes[args['pid']].poll()
+                if returncode is None:
+                    send({'exited': False})
+                else:
+                    send({'exited': True, 'exitcode': returncode})
+
+
+def test_exec(tmp_path):
+    FakeAgent(tmp_path / 'agent')
+    stdout = io.BytesIO()
+    stderr = io.BytesIO()
+    with GuestAgent(tmp_path / 'agent') as agent:
+        returncode = agent.exec(
+            'echo one; sleep .1; echo two; echo oops >&2; exit 3',
+            stdout,
+            stderr,
+        )
+    assert returncode == 3
+    assert stdout.getvalue() == b'one\ntwo\n'
+    assert stderr.getvalue() == b'oops\n'
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import subprocess
+import tarfile
+
+import pytest
+
+from minivirt import archive
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source'
+    path.mkdir()
+    (path / 'config.json').write_text('{}')
+    with (path / 'disk.qcow2').open('wb') as f:
+        f.write(b'data')
+        f.seek(2**20)
+        f.write(b'more data')
+        f.truncate(2**26)
+    return path
+
+
+def extract(fileobj, path):
+    path.mkdir()
+    hashers = {}
+
+    def open_hasher(name):
+        hashers[name] = hashlib.sha256()
+        return hashers[name]
+
+    archive.extract(fileobj, path, open_hasher)
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+def sha256(path):
+    hasher = hashlib.sha256()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def test_sparse_member(source, tmp_path):
+    f = io.BytesIO()
+    archive.create(f, source, ['config.json', 'disk.qcow2'])
+    # Holes are not stored in the archive.
+    assert len(f.getvalue()) < 2**20
+
+    f.seek(0)
+    digests = extract(f, tmp_path / 'target')
+    disk = tmp_path / 'target' / 'disk.qcow2'
+    assert digests['disk.qcow2'] == sha256(disk) == sha256(
+        source / 'disk.qcow2'
+    )
+    assert disk.stat().st_size == 2**26
+    assert disk.stat().st_blocks * 512 < 2**20
+
+
+def test_sparse_member_gnu_tar(source, tmp_path):
+    target = tmp_path / 'target'
+    target.mkdir()
+    f = io.BytesIO()
+    archive.create(f, source, ['disk.qcow2'])
+    try:
+        subprocess.run(
+            ['tar', 'x', '-C', target], input=f.getvalue(), check=True
+        )
+    except FileNotFoundError:
+        pytest.skip('tar is not installed')
+    assert sha256(target / 'disk.qcow2') == sha256(source / 'disk.qcow2')
+
+
+def test_zstd_multiple_frames(source, tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode='w') as tar:
+        tar.add(source / 'config.json', arcname='config.json')
+        tar.add(source / 'config.json', arcname='copy.json')
+    tarball = f.getvalue()
+
+    compressor = zstandard.ZstdCompressor()
+    frames = b''.join(
+        compressor.compress(tarball[offset:offset + 1024])
+        for offset in range(0, len(tarball), 1024)
+    )
+    digests = extract(io.BytesIO(frames), tmp_path / 'target')
+    assert list(digests) == ['config.json', 'copy.json']
+    assert (tmp_path / 'target' / 'copy.json').read_text() == '{}'
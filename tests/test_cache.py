@@ -0,0 +1,115 @@
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from minivirt.cache import Cache
+from minivirt.exceptions import DownloadChecksumMismatch
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        time.sleep(0.1)
+        body = self.path.split('/')[-1].encode('utf8') * 1000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{httpd.server_port}'
+    finally:
+        httpd.shutdown()
+
+
+def test_concurrent_get(server, tmp_path):
+    cache = Cache(tmp_path)
+    paths = []
+    threads = [
+        threading.Thread(target=lambda: paths.append(cache.get(server)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(Handler.requests) == 1
+    assert len(set(paths)) == 1
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 3
+
+
+def test_revalidate(server, tmp_path):
+    cache = Cache(tmp_path)
+    cache.config['max_age'] = 0
+    path = cache.get(f'{server}/a')
+    assert cache.get(f'{server}/a') == path
+    assert path.read_bytes() == b'a' * 1000
+    assert len(Handler.requests) == 2
+    assert cache.stats()['revalidated'] == 1
+
+
+def test_evict_least_recently_used(server, tmp_path):
+    cache = Cache(tmp_path)
+    cache.config['max_size'] = 2500
+    cache.get(f'{server}/a')
+    cache.get(f'{server}/b')
+    cache.get(f'{server}/a')
+    cache.get(f'{server}/c')
+    urls = {url for entry in cache.iter_entries() for url in entry['urls']}
+    assert urls == {f'{server}/a', f'{server}/c'}
+    assert cache.stats()['evictions'] == 1
+
+
+def test_same_content_stored_once(server, tmp_path):
+    cache = Cache(tmp_path)
+    path = cache.get(f'{server}/mirror1/a')
+    assert cache.get(f'{server}/mirror2/a') == path
+    assert path.name == hashlib.sha256(b'a' * 1000).hexdigest()
+    [entry] = cache.iter_entries()
+    assert len(entry['urls']) == 2
+    assert cache.stats()['bytes_deduplicated'] == 1000
+
+
+def test_pinned_digest(server, tmp_path):
+    cache = Cache(tmp_path)
+    digest = hashlib.sha256(b'a' * 1000).hexdigest()
+    path = cache.get(f'{server}/mirror1/a', sha256=digest)
+    assert cache.get(f'{server}/mirror2/a', sha256=digest) == path
+    assert Handler.requests == ['/mirror1/a']
+
+    with pytest.raises(DownloadChecksumMismatch):
+        cache.get(f'{server}/b', sha256='0' * 64)
+    assert [entry['digest'] for entry in cache.iter_entries()] == [digest]
+
+
+def test_migrate_legacy_entry(server, tmp_path):
+    cache = Cache(tmp_path)
+    url = f'{server}/a'
+    (tmp_path / cache.key(url)).write_bytes(b'old')
+    path = cache.get(url)
+    assert path.read_bytes() == b'old'
+    assert not (tmp_path / cache.key(url)).exists()
+    assert Handler.requests == []
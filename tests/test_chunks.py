@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from minivirt.chunks import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, iter_chunks
+
+
+def test_chunk_sizes(tmp_path):
+    path = tmp_path / 'disk'
+    path.write_bytes(os.urandom(16 * 2**20))
+    chunks = list(iter_chunks(path))
+    assert sum(size for _, size in chunks) == 16 * 2**20
+    for _, size in chunks[:-1]:
+        assert MIN_CHUNK_SIZE <= size <= MAX_CHUNK_SIZE
+
+
+@pytest.mark.parametrize('offset, size', [
+    (2**20, 4096),
+    (2**20 + 1, 1),
+    (3 * 2**20 + 7, 13),
+])
+def test_chunks_survive_insert(tmp_path, offset, size):
+    data = os.urandom(16 * 2**20)
+    (tmp_path / 'a').write_bytes(data)
+    changed = data[:offset] + os.urandom(size) + data[offset:]
+    (tmp_path / 'b').write_bytes(changed)
+    a = {digest for digest, _ in iter_chunks(tmp_path / 'a')}
+    b = {digest for digest, _ in iter_chunks(tmp_path / 'b')}
+    assert len(a & b) >= len(a) - 2
+
+
+def test_chunks_survive_delete(tmp_path):
+    data = os.urandom(16 * 2**20)
+    (tmp_path / 'a').write_bytes(data)
+    (tmp_path / 'b').write_bytes(data[:2**20 + 3] + data[2**20 + 4:])
+    a = {digest for digest, _ in iter_chunks(tmp_path / 'a')}
+    b = {digest for digest, _ in iter_chunks(tmp_path / 'b')}
+    assert len(a & b) >= len(a) - 2
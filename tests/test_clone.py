@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from minivirt import clone
+from minivirt.clone import clone_file
+
+
+@pytest.fixture
+def sparse_file(tmp_path):
+    path = tmp_path / 'src'
+    with path.open('wb') as f:
+        f.write(os.urandom(4096))
+        f.seek(64 * 2**20)
+        f.write(os.urandom(4096))
+    return path
+
+
+@pytest.mark.parametrize('method', [None, 'copy_file_range', 'sparse'])
+def test_clone_file(sparse_file, tmp_path, monkeypatch, method):
+    if method:
+        methods = [m for m in clone.METHODS if m[0] == method]
+        if not methods:
+            pytest.skip(f'{method} not available')
+        monkeypatch.setattr(clone, 'METHODS', methods)
+
+    target = tmp_path / 'dst'
+    used = clone_file(sparse_file, target)
+    assert method is None or used == method
+    assert target.read_bytes() == sparse_file.read_bytes()
+    assert target.stat().st_blocks * 512 < 2**20
+
+
+def test_clone_immutable(sparse_file, tmp_path):
+    target = tmp_path / 'dst'
+    assert clone_file(sparse_file, target, immutable=True) == 'hardlink'
+    assert target.stat().st_ino == sparse_file.stat().st_ino
@@ -0,0 +1,43 @@
+from io import BytesIO
+
+import pytest
+
+from minivirt import archive
+from minivirt.db import DB, ImageCreator, combine_digests, tree_digests
+from minivirt.exceptions import ImageChecksumMismatch
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source'
+    path.mkdir()
+    (path / 'disk.qcow2').write_bytes(b'Hello, World!' * 3)
+    return path
+
+
+def stream(source, scheme):
+    (source / 'config.json').write_text(f'{{"checksum": "{scheme}"}}')
+    fileobj = BytesIO()
+    archive.create(fileobj, source, ['config.json', 'disk.qcow2'])
+    fileobj.seek(0)
+    return fileobj
+
+
+@pytest.mark.parametrize('scheme', ['sha256', 'merkle'])
+def test_streamed_digest_matches_tree(tmp_path, source, monkeypatch, scheme):
+    monkeypatch.setattr('minivirt.db.CHUNK_SIZE', 4)
+    creator = ImageCreator(DB(tmp_path / 'db'))
+    creator.extract(stream(source, scheme))
+    assert creator.digests == tree_digests(creator.path)
+
+    expected_id = combine_digests(tree_digests(source))
+    image = creator.commit(expected_id)
+    assert image.name == expected_id
+    assert combine_digests(tree_digests(image.path)) == expected_id
+
+
+def test_streamed_digest_mismatch(tmp_path, source):
+    creator = ImageCreator(DB(tmp_path / 'db'))
+    creator.extract(stream(source, 'sha256'))
+    with pytest.raises(ImageChecksumMismatch):
+        creator.commit('0' * 64)
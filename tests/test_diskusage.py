@@ -0,0 +1,24 @@
+import pytest
+
+from minivirt.diskusage import format_size
+
+
+@pytest.mark.parametrize('size, expected', [
+    (0, '0'),
+    (4096, '4.0K'),
+    (5000, '4.9K'),
+    (120 * 2**20, '120M'),
+    (1.4 * 2**30, '1.4G'),
+])
+def test_format_size(size, expected):
+    assert format_size(size) == expected
+
+
+def test_vm_usage(db, vm):
+    image_disk = db.get_image('base').get_usage()['disks']['disk.qcow2']
+    usage = vm.get_usage()
+    disk = usage['disks']['disk.qcow2']
+    assert disk['virtual_size'] == image_disk['virtual_size']
+    assert disk['backing_file'].endswith('/disk.qcow2')
+    assert disk['allocated_in_layer'] < image_disk['allocated_in_layer']
+    assert usage['allocated'] >= disk['allocated_in_layer']
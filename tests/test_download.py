@@ -0,0 +1,82 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from minivirt.download import RangeDownload
+
+DATA = os.urandom(10000)
+
+
+class Handler(BaseHTTPRequestHandler):
+    ranges = True
+    requests = []
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        m = re.match(r'bytes=(\d+)-(\d+)$', header or '')
+        if m and self.ranges:
+            start, end = int(m.group(1)), min(int(m.group(2)), len(DATA) - 1)
+            self.requests.append((start, end))
+            body = DATA[start:end + 1]
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', f'bytes {start}-{end}/{len(DATA)}'
+            )
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.ranges = True
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{httpd.server_port}/blob'
+    finally:
+        httpd.shutdown()
+
+
+def read_all(download):
+    with download.open() as f:
+        return b''.join(iter(lambda: f.read(777), b''))
+
+
+def test_parallel_download(server, tmp_path):
+    download = RangeDownload(server, tmp_path / 'blob', part_size=1000)
+    assert read_all(download) == DATA
+    assert len(Handler.requests) == 1 + 10
+
+
+def test_resume_download(server, tmp_path):
+    download = RangeDownload(server, tmp_path / 'blob', part_size=1000)
+    download.state = download.load_state(len(DATA), '"v1"')
+    with download.path.open('r+b') as f:
+        f.write(DATA[:3000])
+    download.state['done'] = [0, 1, 2]
+    download.save_state(download.state)
+
+    Handler.requests = []
+    assert read_all(download) == DATA
+    assert sorted(Handler.requests)[1:] == [
+        (start, start + 999) for start in range(3000, 10000, 1000)
+    ]
+
+
+def test_download_without_ranges(server, tmp_path):
+    Handler.ranges = False
+    download = RangeDownload(server, tmp_path / 'blob', part_size=1000)
+    assert read_all(download) == DATA
@@ -25,3 +25,41 @@ def test_dangling_tag(db):
     result = db.fsck()
     assert len(result.errors) == 1
     assert 'target image does not exist' in result.errors[0]
+
+
+def test_fast_fsck_detects_modified_file(db):
+    image = db.get_image('base')
+    try:
+        with (image.path / 'config.json').open('a') as f:
+            f.write(' ')
+        result = db.fsck(fast=True)
+        assert result.errors == [f'{image}: invalid checksum for config.json']
+    finally:
+        shutil.rmtree(image.path)
+
+
+def test_sampled_fsck_detects_corrupt_chunk(db, monkeypatch):
+    monkeypatch.setattr('minivirt.db.CHUNK_SIZE', 4)
+    with db.create_image() as creator:
+        with (creator.path / 'config.json').open('w') as f:
+            f.write('{"checksum": "merkle"}')
+        with (creator.path / 'foo').open('wb') as f:
+            f.write(b'Hello, World!')
+    image = creator.image
+    try:
+        assert not list(image.fsck(sample=1))
+        with (image.path / 'foo').open('r+b') as f:
+            f.write(b'J')
+        assert list(image.fsck(sample=1)) == ['invalid chunk 0 in foo']
+    finally:
+        shutil.rmtree(image.path)
+
+
+def test_fsck_is_read_only(db):
+    image = db.get_image('base')
+    manifest = image.path / '.manifest.json'
+    manifest.unlink()
+    assert not db.fsck().errors
+    assert not manifest.exists()
+    assert not db.fsck(repair=True).errors
+    assert manifest.exists()
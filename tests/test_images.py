@@ -1,8 +1,10 @@
+import io
+import tarfile
 import tempfile
 
 import pytest
 
-from minivirt.exceptions import ImageNotFound
+from minivirt.exceptions import ImageChecksumMismatch, ImageNotFound
 from minivirt.vms import VM
 
 
@@ -28,6 +30,53 @@ def test_save_restore_run(db):
         db.remove_image('newly-loaded-image')
 
 
+@pytest.mark.parametrize('compression', [None, 'gzip', 'zstd'])
+def test_save_load_sparse(db, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+
+    with db.create_image() as creator:
+        with (creator.path / 'disk.qcow2').open('wb') as f:
+            f.write(b'data')
+            f.truncate(2**30)
+    image = creator.image
+
+    with tempfile.TemporaryFile() as f:
+        db.save(image.name, stdout=f, compression=compression)
+        assert f.tell() < 2**20
+        f.seek(0)
+        image.delete()
+        loaded = db.load(None, stdin=f)
+
+    try:
+        assert loaded.name == image.name
+        stat = (loaded.path / 'disk.qcow2').stat()
+        assert stat.st_size == 2**30
+        assert stat.st_blocks * 512 < 2**20
+    finally:
+        loaded.delete()
+
+
+def test_load_checks_expected_id(db):
+    with tempfile.TemporaryFile() as f:
+        db.save('base', stdout=f)
+        f.seek(0)
+        with pytest.raises(ImageChecksumMismatch):
+            db.load(None, stdin=f, expected_id='0' * 64)
+
+
+def test_load_rejects_unsafe_paths(db):
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode='w') as tar:
+        member = tarfile.TarInfo('../outside')
+        tar.addfile(member, io.BytesIO())
+    f.seek(0)
+
+    with pytest.raises(ValueError):
+        db.load('unsafe-image', stdin=f)
+    assert not (db.images_path.parent / 'outside').exists()
+
+
 def test_commit_run(db, vm):
     db.get_vm('bar').destroy()
     db.remove_image('newly-committed-image')
@@ -51,6 +100,35 @@ def test_commit_run(db, vm):
         db.remove_image('newly-committed-image')
 
 
+def test_layered_commit_and_flatten(db, vm):
+    db.get_vm('bar').destroy()
+    base = db.get_image('base')
+    with vm.run(wait_for_ssh=30):
+        vm.ssh('touch marker-file && poweroff')
+
+    image = vm.commit()
+    assert image.parent_id == base.name
+
+    flat = image.flatten()
+    assert flat.parent_id is None
+    assert not list(flat.fsck())
+
+    bar = VM.create(db, 'bar', image=flat, memory=512)
+    try:
+        assert image.name not in db.index.used_image_ids()
+        vm.destroy()
+        image.tag('layered-image')
+        assert base.name in db.index.used_image_ids()
+
+        with bar.run(wait_for_ssh=60):
+            out = bar.ssh('ls', capture=True)
+        assert out.strip() == b'marker-file'
+
+    finally:
+        bar.destroy()
+        db.remove_image('layered-image')
+
+
 def test_commit_overwrite_tag(db, vm):
     vm.commit().tag('thing')
     thing_id = db.get_image('thing').name
@@ -73,7 +151,61 @@ def test_checksum(db):
     )
 
 
+def test_merkle_checksum(db, monkeypatch):
+    monkeypatch.setattr('minivirt.db.CHUNK_SIZE', 4)
+    with db.create_image() as creator:
+        with (creator.path / 'config.json').open('w') as f:
+            f.write('{"checksum": "merkle"}')
+        with (creator.path / 'foo').open('wb') as f:
+            f.write(b'Hello, World!')
+    # foo:9a9bfca87e34b4253954b196a1572cb135b206f29ecd78a8bf91ca116412d8b6
+    assert creator.image.name == (
+        'e49d8041e871f8ece3e3237edd79821170e6910a541d49b24de1d60eb7825abf'
+    )
+    assert not list(creator.image.fsck())
+
+
 @pytest.mark.parametrize('image_name', ['', 'nothing', 'a'*64])
 def test_image_not_found(db, image_name):
     with pytest.raises(ImageNotFound):
         db.get_image(image_name)
+
+
+def test_commit_with_state(db, vm):
+    db.get_vm('bar').destroy()
+    with vm.run(wait_for_ssh=30):
+        vm.ssh('echo hello > /tmp/in-memory')
+        image = vm.commit(state=True)
+    assert image.config['state'] == 'memory.state'
+    assert not list(image.fsck())
+
+    bar = VM.create(db, 'bar', image=image, memory=512)
+    try:
+        assert bar.state_path == image.path / 'memory.state'
+        with bar.run(wait_for_ssh=10):
+            out = bar.ssh('cat /tmp/in-memory', capture=True)
+        assert out.strip() == b'hello'
+        assert bar.state_path is None
+
+    finally:
+        bar.destroy()
+
+
+def test_commit_with_shared_memory(db, vm):
+    with vm.run(wait_for_ssh=30, shared_memory=True):
+        image = vm.commit(state=True)
+    assert image.config['ram'] == 'memory.ram'
+
+    clones = [
+        VM.create(db, f'clone-{n}', image=image, memory=512) for n in range(2)
+    ]
+    try:
+        for clone in clones:
+            clone.start(daemon=True, wait_for_ssh=10)
+        for clone in clones:
+            clone.ssh('true')
+            assert clone.get_memory_usage()['shared'] > 0
+
+    finally:
+        for clone in clones:
+            clone.destroy()
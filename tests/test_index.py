@@ -0,0 +1,37 @@
+import sqlite3
+
+import pytest
+
+from minivirt.index import Index
+
+
+def test_tag_is_indexed(db):
+    image = db.get_image('base')
+    image.tag('indexed-tag')
+    try:
+        assert 'indexed-tag' in [tag.name for tag in image.iter_tags()]
+    finally:
+        db.remove_image('indexed-tag')
+    assert 'indexed-tag' not in [tag.name for tag in image.iter_tags()]
+
+
+def test_vm_is_indexed(db, vm):
+    assert vm.name in [v.name for v in db.iter_vms()]
+    vm.destroy()
+    assert vm.name not in [v.name for v in db.iter_vms()]
+
+
+def test_reindex(db, vm):
+    expected = db.index.image_ids(), db.index.tags(), db.index.vms()
+    db.index.path.unlink()
+    db.reindex()
+    assert (db.index.image_ids(), db.index.tags(), db.index.vms()) == expected
+
+
+def test_replace_is_atomic(tmp_path):
+    index = Index(tmp_path / 'index.sqlite')
+    index.replace([('a', None)], [('t', 'a')], [])
+    with pytest.raises(sqlite3.IntegrityError):
+        index.replace([('b', None)], [('t', 'b'), ('t', 'b')], [])
+    assert index.images() == [('a', None)]
+    assert index.tags() == [('t', 'a')]
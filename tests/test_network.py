@@ -10,6 +10,12 @@ def test_connect_with_ssh(vm):
     assert out.strip() == b'alpine'
 
 
+def test_ssh_batch(vm):
+    with vm.run(wait_for_ssh=30):
+        out = vm.ssh_batch(['hostname', 'echo hi'], capture=True)
+    assert [line.strip() for line in out] == [b'alpine', b'hi']
+
+
 def test_tcp_port(db):
     db.get_vm('foo').destroy()
     base = db.get_image('base')
@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+import pytest
+
+from minivirt.pool import Pool
+
+
+@pytest.fixture
+def pool(db, monkeypatch):
+    monkeypatch.setattr(db.pool, 'fill_in_background', lambda: None)
+    image = db.get_image('base')
+    db.pool.set_target(image, 1, memory=512)
+    try:
+        yield db.pool
+    finally:
+        db.pool.set_target(image, 0)
+        db.pool.drain()
+
+
+def test_run_from_pool(db, pool):
+    image = db.get_image('base')
+    pool.fill()
+    assert pool.stats()['vms'][image.name] == {'idle': 1}
+
+    hits = pool.stats()['hits']
+    with pool.run(image, memory=512) as vm:
+        assert vm.name.startswith('_pool-')
+        vm.ssh('true')
+    assert pool.stats()['hits'] == hits + 1
+    assert list(pool.iter_vms()) == []
+
+
+def test_pool_miss(db, pool):
+    image = db.get_image('base')
+    misses = pool.stats()['misses']
+    with pool.run(image, memory=256) as vm:
+        assert not vm.name.startswith('_pool-')
+    assert pool.stats()['misses'] == misses + 1
+
+
+def test_set_target_keeps_settings(tmp_path):
+    pool = Pool(SimpleNamespace(path=tmp_path))
+    image = SimpleNamespace(name='abc')
+    with pytest.raises(ValueError):
+        pool.set_target(image, memory=512)
+
+    pool.set_target(image, 2, memory=512)
+    pool.set_target(image, memory=256)
+    assert pool.targets() == {'abc': {'size': 2, 'memory': 256}}
+    pool.set_target(image, 3)
+    assert pool.targets() == {'abc': {'size': 3, 'memory': 256}}
+    pool.set_target(image, 0)
+    assert pool.targets() == {}
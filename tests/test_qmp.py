@@ -0,0 +1,95 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from minivirt.exceptions import QMPError, WaitTimeout
+from minivirt.qmp import QMP
+
+
+class FakeQEMU:
+    def __init__(self, path, greet=True):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(str(path))
+        self.sock.listen(1)
+        self.greet = greet
+        self.received = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        conn, _ = self.sock.accept()
+        self.conn = conn
+        if not self.greet:
+            return
+        writer = conn.makefile('w')
+
+        def send(msg):
+            writer.write(json.dumps(msg) + '\r\n')
+            writer.flush()
+
+        send({'QMP': {'version': {}, 'capabilities': []}})
+        batch = []
+        for line in conn.makefile('r'):
+            msg = json.loads(line)
+            self.received.append(msg['execute'])
+            if msg['execute'] == 'slow':
+                batch.append(msg)
+                continue
+            if msg['execute'] == 'fast':
+                # Reply out of order, after the slow commands.
+                send({'return': 'fast', 'id': msg['id']})
+                for slow in batch:
+                    send({'return': 'slow', 'id': slow['id']})
+                batch = []
+            elif msg['execute'] == 'fail':
+                send({'error': {'desc': 'nope'}, 'id': msg['id']})
+            elif msg['execute'] == 'system_powerdown':
+                send({'return': {}, 'id': msg['id']})
+                send({'event': 'POWERDOWN', 'data': {}})
+            elif msg['execute'] == 'quit':
+                send({'event': 'SHUTDOWN', 'data': {}})
+                conn.close()
+                return
+            else:
+                send({'return': {}, 'id': msg['id']})
+
+
+def test_pipelined_commands(tmp_path):
+    FakeQEMU(tmp_path / 'qmp')
+    qmp = QMP(tmp_path / 'qmp')
+    replies = qmp.execute_many([('slow', {}), ('slow', {}), ('fast', {})])
+    assert replies == ['slow', 'slow', 'fast']
+
+    with pytest.raises(QMPError):
+        qmp.execute('fail')
+
+
+def test_late_reply(tmp_path):
+    FakeQEMU(tmp_path / 'qmp')
+    qmp = QMP(tmp_path / 'qmp')
+    with pytest.raises(WaitTimeout):
+        qmp.execute('slow', timeout=0.2)
+    # The reply to `slow` arrives after this one, and is dropped.
+    assert qmp.execute('fast') == 'fast'
+    assert qmp.execute('query-status') == {}
+    assert not qmp.is_closed
+
+
+def test_events(tmp_path):
+    FakeQEMU(tmp_path / 'qmp')
+    qmp = QMP(tmp_path / 'qmp')
+    with qmp.subscribe('POWERDOWN', 'SHUTDOWN') as events:
+        qmp.poweroff()
+        assert events.get(timeout=5)['event'] == 'POWERDOWN'
+        qmp.quit()
+        assert events.get(timeout=5)['event'] == 'SHUTDOWN'
+    qmp.wait_closed(timeout=5)
+    assert qmp.is_closed
+
+
+def test_busy_monitor(tmp_path):
+    qemu = FakeQEMU(tmp_path / 'qmp', greet=False)
+    with pytest.raises(WaitTimeout):
+        QMP(tmp_path / 'qmp', timeout=0.2)
+    assert qemu.received == []
@@ -0,0 +1,101 @@
+import queue
+import socket
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from minivirt.exceptions import WaitTimeout
+from minivirt.readiness import Readiness
+from minivirt.statusline import StatusLine
+
+
+def serve_banner():
+    sock = socket.create_server(('localhost', 0))
+
+    def serve():
+        while True:
+            conn, _ = sock.accept()
+            conn.sendall(b'SSH-2.0-fake\r\n')
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def closed_port():
+    with socket.create_server(('localhost', 0)) as sock:
+        return sock.getsockname()[1]
+
+
+class FakeSubscription:
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def get(self, timeout=None):
+        event = self.events.get(timeout=timeout)
+        if event is None:
+            raise ConnectionResetError('QEMU is gone')
+        return event
+
+    def close(self):
+        self.events.put(None)
+
+
+class FakeVM:
+    def __init__(self, **config):
+        self.config = config
+        self.subscription = FakeSubscription()
+        self.connected = False
+
+    def connect_qmp(self):
+        self.connected = True
+        return SimpleNamespace(subscribe=lambda name: self.subscription)
+
+    def disconnect_qmp(self):
+        self.connected = False
+
+
+def test_ready_marker():
+    vm = FakeVM(ready_marker=r'sshd .* ok')
+    sl = StatusLine(vm)
+    with Readiness(vm, sl) as readiness:
+        for listener in sl.listeners:
+            listener('Starting sshd ... [ ok ]')
+        readiness.wait(serve_banner(), 5)
+
+    assert sl.listeners == []
+    assert list(readiness.timings) == ['boot', 'ssh']
+
+
+def test_agent_releases_qmp():
+    vm = FakeVM(agent=True)
+    vm.subscription.events.put({'data': {'open': True}})
+    with Readiness(vm, StatusLine(vm)) as readiness:
+        readiness.wait(serve_banner(), 5)
+        assert not vm.connected
+    assert list(readiness.timings) == ['qemu', 'boot', 'ssh']
+
+
+def test_missing_marker_falls_back_to_banner(monkeypatch):
+    monkeypatch.setattr('minivirt.readiness.FALLBACK_INTERVAL', 0.1)
+    vm = FakeVM(ready_marker='never', agent=True)
+    with Readiness(vm, StatusLine(vm)) as readiness:
+        readiness.wait(serve_banner(), 5)
+        assert not vm.connected
+    assert list(readiness.timings) == ['qemu', 'ssh']
+
+
+def test_timeout():
+    vm = FakeVM(ready_marker='never', agent=True)
+    with Readiness(vm, StatusLine(vm)) as readiness:
+        with pytest.raises(WaitTimeout):
+            readiness.wait(closed_port(), 0.2)
+        assert not vm.connected
+
+
+def test_banner_only():
+    vm = FakeVM(ready_marker='never')
+    with Readiness(vm, StatusLine(vm), resumed=True) as readiness:
+        readiness.wait(serve_banner(), 5)
+    assert list(readiness.timings) == ['ssh']
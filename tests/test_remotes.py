@@ -0,0 +1,221 @@
+import gzip
+import io
+import os
+import tarfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import botocore.exceptions
+import pytest
+
+from minivirt.db import DB
+from minivirt.remotes import Remote, S3Bucket
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.puts = []
+        self.heads = []
+        self.completed = {}
+        self.lock = threading.Lock()
+
+    def head_object(self, Bucket, Key):
+        self.heads.append(Key)
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': '404'}}, 'HeadObject'
+            )
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken='0'):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        start = int(ContinuationToken)
+        page = {
+            'Contents': [{'Key': key} for key in keys[start:start + 2]],
+            'IsTruncated': start + 2 < len(keys),
+        }
+        if page['IsTruncated']:
+            page['NextContinuationToken'] = str(start + 2)
+        return page
+
+    def put_object(self, Bucket, Key, Body):
+        with self.lock:
+            self.objects[Key] = Body
+            self.puts.append(Key)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f'upload-{len(self.uploads)}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        parts = self.uploads.pop(UploadId)
+        numbers = [
+            part['PartNumber'] for part in kwargs['MultipartUpload']['Parts']
+        ]
+        assert numbers == sorted(parts)
+        self.objects[Key] = b''.join(parts[number] for number in numbers)
+        self.completed[Key] = len(numbers)
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket, Key, f.read())
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append(Key)
+
+
+class Handler(BaseHTTPRequestHandler):
+    objects = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        body = self.objects.get(self.path.lstrip('/'))
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve(objects):
+    Handler.objects = objects
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{httpd.server_port}'
+    finally:
+        httpd.shutdown()
+
+
+def test_upload_stream():
+    s3 = FakeS3()
+    bucket = S3Bucket('test', s3=s3)
+    data = bytes(range(256)) * 1000
+    with bucket.upload_stream('blob', part_size=1000) as upload:
+        for offset in range(0, len(data), 777):
+            upload.write(data[offset:offset + 777])
+    assert s3.objects['blob'] == data
+
+
+def test_upload_stream_aborts_on_error():
+    s3 = FakeS3()
+    bucket = S3Bucket('test', s3=s3)
+    with pytest.raises(RuntimeError):
+        with bucket.upload_stream('blob', part_size=1000) as upload:
+            upload.write(b'x' * 5000)
+            raise RuntimeError
+    assert s3.aborted == ['blob']
+    assert 'blob' not in s3.objects
+
+
+def test_push(tmp_path, monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(
+        'minivirt.remotes.S3Bucket', lambda name: S3Bucket(name, s3=s3)
+    )
+    db = DB(tmp_path / 'db')
+    with db.create_image() as creator:
+        (creator.path / 'config.json').write_text('{}')
+        # Random data doesn't compress, so it spans several parts.
+        (creator.path / 'disk.qcow2').write_bytes(os.urandom(20 * 2**20))
+    image = creator.image
+
+    Remote(db, 'test', 'http://127.0.0.1/test').push(image, 'latest')
+    key = f'images/{image.name}.tgz'
+    assert s3.completed[key] == 2
+    assert s3.objects['tags/latest'] == image.name.encode('utf8')
+    with gzip.open(io.BytesIO(s3.objects[key])) as f:
+        with tarfile.open(fileobj=f) as tar:
+            assert 'disk.qcow2' in tar.getnames()
+
+
+def test_chunked_push_and_pull(tmp_path):
+    s3 = FakeS3()
+    bucket = S3Bucket('test', s3=s3)
+    disk = os.urandom(8 * 2**20)
+
+    source = DB(tmp_path / 'source')
+    with source.create_image() as creator:
+        (creator.path / 'config.json').write_text('{"checksum": "merkle"}')
+        (creator.path / 'disk.qcow2').write_bytes(disk)
+    image = creator.image
+    remote = Remote(source, 'test', 'http://127.0.0.1/test')
+    remote.push_chunks(bucket, image)
+    chunk_keys = [key for key in s3.objects if key.startswith('chunks/')]
+    assert f'manifests/{image.name}.json' in s3.objects
+
+    # Pushing again uploads nothing new.
+    s3.puts.clear()
+    s3.heads.clear()
+    del s3.objects[f'manifests/{image.name}.json']
+    remote.push_chunks(bucket, image)
+    assert s3.puts == [f'manifests/{image.name}.json']
+    assert s3.heads == [f'manifests/{image.name}.json']
+
+    with serve(s3.objects) as url:
+        target = DB(tmp_path / 'target')
+        pulled = Remote(target, 'test', url).pull_image(image.name)
+        assert pulled.name == image.name
+        assert (pulled.path / 'disk.qcow2').read_bytes() == disk
+        assert len(Handler.requests) == len(chunk_keys) + 1
+
+        # A derived image only fetches the chunks that changed.
+        with source.create_image() as creator:
+            (creator.path / 'config.json').write_text(
+                '{"checksum": "merkle"}'
+            )
+            (creator.path / 'disk.qcow2').write_bytes(
+                disk[:2**20 + 1] + os.urandom(1) + disk[2**20 + 1:]
+            )
+        remote.push_chunks(bucket, creator.image)
+        Handler.requests = []
+        pulled = Remote(target, 'test', url).pull_image(creator.image.name)
+        assert pulled.name == creator.image.name
+        fetched = [path for path in Handler.requests if '/chunks/' in path]
+        assert len(fetched) <= 3
+
+
+def test_chunked_pull_reuses_local_image(tmp_path):
+    s3 = FakeS3()
+    bucket = S3Bucket('test', s3=s3)
+    disk = os.urandom(8 * 2**20)
+    changed = disk[:2**20] + os.urandom(1) + disk[2**20:]
+
+    source = DB(tmp_path / 'source')
+    with source.create_image() as creator:
+        (creator.path / 'config.json').write_text('{}')
+        (creator.path / 'disk.qcow2').write_bytes(changed)
+    remote = Remote(source, 'test', 'http://127.0.0.1/test')
+    remote.push_chunks(bucket, creator.image)
+
+    # The target has the original image, but never saw it chunked.
+    target = DB(tmp_path / 'target')
+    with target.create_image() as local:
+        (local.path / 'config.json').write_text('{}')
+        (local.path / 'disk.qcow2').write_bytes(disk)
+
+    with serve(s3.objects) as url:
+        pulled = Remote(target, 'test', url).pull_image(creator.image.name)
+    assert (pulled.path / 'disk.qcow2').read_bytes() == changed
+    fetched = [path for path in Handler.requests if '/chunks/' in path]
+    assert len(fetched) <= 3
@@ -0,0 +1,27 @@
+from minivirt.stats import History, percentile
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 99) == 99
+    assert percentile([7], 90) == 7
+
+
+def test_summarize(tmp_path):
+    history = History(tmp_path / 'stats.jsonl')
+    for seconds in [1, 2, 3, 4]:
+        history.append(
+            'boot', {'qemu': 0.5, 'ssh': seconds}, image='foo', qemu='7.1.0'
+        )
+    history.append('boot', {'ssh': 10}, image='bar', qemu='7.1.0')
+    with history.path.open('a') as f:
+        f.write('{"truncated\n')
+
+    summary = history.summarize(image='foo')
+    assert list(summary) == [('foo', '7.1.0', 'boot')]
+    phases = summary['foo', '7.1.0', 'boot']
+    assert phases['ssh'] == {
+        'count': 4, 'p50': 2, 'p90': 4, 'p99': 4, 'max': 4,
+    }
+    assert phases['total']['max'] == 4.5
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import pytest
+
+from minivirt import throttle
+
+
+class FakeVM:
+    def __init__(self, name, group, is_running=True):
+        self.name = name
+        self.config = {'throttle_group': group}
+        self.is_running = is_running
+        self.applied = []
+
+    def apply_io_throttle(self, share=None):
+        self.applied.append(share)
+
+
+def test_parse_limits():
+    assert throttle.parse_limits('iops=500,bps=50M,bps_max_length=10') == {
+        'iops': 500,
+        'bps': 50 * 2**20,
+        'bps_max_length': 10,
+    }
+    with pytest.raises(ValueError):
+        throttle.parse_limits('speed=fast')
+
+
+def test_drive_options():
+    assert throttle.drive_options({'iops': 500, 'bps_wr_max': 10}, 'vm') == {
+        'throttling.iops-total': 500,
+        'throttling.bps-write-max': 10,
+        'throttling.group': 'vm',
+    }
+    assert throttle.drive_options({}, 'vm') == {}
+
+
+def test_combine():
+    limits = throttle.combine(
+        {'iops': 500, 'iops_max': 600, 'bps': 0},
+        {'iops': 1000, 'iops_max': 400, 'bps': 100},
+    )
+    # The burst can't be lower than the sustained rate.
+    assert limits == {'iops': 500, 'iops_max': 500, 'bps': 100}
+
+    # QEMU refuses a total limit next to read/write limits.
+    assert throttle.combine({'bps_wr': 10}, {'bps': 100}) == {
+        'bps_rd': 90,
+        'bps_wr': 10,
+    }
+    assert throttle.combine(
+        {'iops_rd': 80, 'iops_wr': 80},
+        {'iops': 100, 'iops_max': 300, 'iops_max_length': 5},
+    ) == {
+        'iops_rd': 50,
+        'iops_wr': 50,
+        'iops_rd_max': 150,
+        'iops_wr_max': 150,
+        'iops_rd_max_length': 5,
+        'iops_wr_max_length': 5,
+    }
+
+
+def test_divide():
+    assert throttle.divide(
+        {'iops': 900, 'iops_size': 4096, 'iops_max_length': 5}, 3
+    ) == {'iops': 300, 'iops_size': 4096, 'iops_max_length': 5}
+
+
+def test_rebalance(tmp_path):
+    vms = [FakeVM('a', 'ci'), FakeVM('b', 'ci'), FakeVM('c', None)]
+    db = SimpleNamespace(path=tmp_path, iter_vms=lambda: iter(vms))
+    groups = throttle.ThrottleGroups(db)
+    groups.set_group('ci', {'iops': 900, 'iops_max_length': 5})
+    assert vms[0].applied == [{'iops': 450, 'iops_max_length': 5}]
+    assert vms[2].applied == []
+
+    new = FakeVM('d', 'ci', is_running=False)
+    assert groups.share(new) == {'iops': 300, 'iops_max_length': 5}
+    groups.rebalance('ci', starting=new)
+    assert vms[1].applied[-1] == {'iops': 300, 'iops_max_length': 5}
+    assert new.applied == []
+
+    # Once its QEMU is up, the new member rebalances again, itself included.
+    new.is_running = True
+    vms.append(new)
+    groups.rebalance('ci')
+    assert new.applied == [{'iops': 300, 'iops_max_length': 5}]
+    assert vms[0].applied[-1] == {'iops': 300, 'iops_max_length': 5}
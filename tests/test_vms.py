@@ -1,7 +1,13 @@
+import os
+import struct
+
 import pytest
 
 from minivirt.exceptions import VmIsRunning
 from minivirt.utils import waitfor
+from minivirt.vms import (
+    Disk, l2_cache_size, process_start_time, read_smaps_rollup,
+)
 
 
 def test_start_started_vm_raises_exception(vm):
@@ -9,3 +15,42 @@ def test_start_started_vm_raises_exception(vm):
         waitfor(lambda: vm.is_running)
         with pytest.raises(VmIsRunning):
             vm.start()
+
+
+def test_read_smaps_rollup():
+    usage = read_smaps_rollup(os.getpid())
+    assert usage['Rss'] > 0
+
+
+def test_process_start_time():
+    start_time = process_start_time(os.getpid())
+    assert start_time is not None
+    assert process_start_time(os.getpid()) == start_time
+    assert process_start_time(2**22 + 1) is None
+
+
+def test_disk_args(tmp_path):
+    raw_path = tmp_path / 'raw.img'
+    raw_path.write_bytes(b'\0' * 512)
+    args = Disk(raw_path).get_qemu_args(
+        'drive0', {'cache': 'none', 'aio': 'io_uring'}, iothread=True
+    )
+    assert args == [
+        '-drive', f'if=none,id=drive0,file={raw_path},cache=none,aio=io_uring',
+        '-object', 'iothread,id=drive0-io',
+        '-device', 'virtio-blk-pci,drive=drive0,iothread=drive0-io',
+    ]
+
+
+def test_l2_cache_size(tmp_path):
+    path = tmp_path / 'disk.qcow2'
+    header = struct.pack(
+        '>4sIQIIQIIQ', b'QFI\xfb', 3, 0, 0, 16, 10 * 2**30, 0, 0, 0
+    )
+    path.write_bytes(header.ljust(104, b'\0'))
+    # One 8-byte L2 entry per 64 KiB cluster.
+    assert l2_cache_size(path) == 10 * 2**30 // 2**16 * 8
+
+    raw_path = tmp_path / 'raw.img'
+    raw_path.write_bytes(b'\0' * 512)
+    assert l2_cache_size(raw_path) is None